@@ -0,0 +1,246 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+"""Offline benchmark of the download scheduler
+
+Runs extractor.py against the stub youtube-dl next to this file, optionally
+fetching media from a local HTTP server, and reports throughput, job latency
+percentiles, peak RSS and CPU time. Nothing touches the network.
+
+    python3 benchmark/run.py --workers 1,8,64 --urls 1000 --engine thread,asyncio
+    python3 benchmark/run.py --scheduler-only --workers 1,16,256 --urls 100000
+    python3 benchmark/run.py --segments 1,4,16 --size 104857600 --connection-rate 10485760
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import tempfile
+import resource
+import itertools
+import threading
+import subprocess
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+def parse_opts():
+    arguments = ArgumentParser(usage='usage: [options]')
+    arguments.add_argument('--workers', help='Comma separated worker counts to try.', dest='workers', type=str, default='1,8,64')
+    arguments.add_argument('--urls', help='Number of urls per run.', dest='urls', type=int, default=1000)
+    arguments.add_argument('--engine', help='Comma separated engines to try.', dest='engine', type=str, default='thread')
+    arguments.add_argument('--batch-size', help='Urls per youtube-dl process.', dest='batch_size', type=int, default=1)
+    arguments.add_argument('--latency', help='Stub extraction latency in seconds.', dest='latency', type=float, default=0.05)
+    arguments.add_argument('--size', help='Bytes per video.', dest='size', type=int, default=1048576)
+    arguments.add_argument('--progress-lines', help='Progress lines printed per video.', dest='progress', type=int, default=10)
+    arguments.add_argument('--failure-rate', help='Probability of a video failing.', dest='failure_rate', type=float, default=0.0)
+    arguments.add_argument('--server', help='Fetch media from a local HTTP server.', dest='server', action='store_true', default=False)
+    arguments.add_argument('--segments', help='Comma separated connection counts, benchmark the segmented downloader only.', dest='segments', type=str)
+    arguments.add_argument('--connection-rate', help='Bytes per second the local server sends on each connection.', dest='connection_rate', type=int, default=0)
+    arguments.add_argument('--scheduler-only', help='Run no-op jobs through ThreadingManager only.', dest='scheduler_only', action='store_true', default=False)
+    arguments.add_argument('--json', help='Print results as JSON lines.', dest='json', action='store_true', default=False)
+    arguments.add_argument('--child', help=None, dest='child', type=str)
+    return arguments.parse_args()
+
+class MediaHandler(BaseHTTPRequestHandler):
+    """Serve /<size> as size bytes of zeros, honouring byte ranges"""
+    CHUNK = b'\0' * 65536
+    protocol_version = 'HTTP/1.1'
+    # per connection bytes per second, 0 for unlimited
+    rate = 0
+
+    def do_GET(self):
+        try:
+            size = int(self.path.strip('/').split('/')[-1])
+        except ValueError:
+            self.send_error(404)
+            return
+        start, end = 0, size - 1
+        ranges = re.match(r'^bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if ranges:
+            start = int(ranges.group(1))
+            end = min(int(ranges.group(2)), size - 1) if ranges.group(2) else size - 1
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        length = end - start + 1
+        started = time.time()
+        sent = 0
+        while sent < length:
+            chunk = self.CHUNK[:length - sent]
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            if self.rate:
+                time.sleep(max(0, sent / float(self.rate) - (time.time() - started)))
+
+    def log_message(self, *args):
+        pass
+
+def start_server():
+    """Start the local media server, return its url"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MediaHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_port)
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def usage():
+    """Peak RSS in MiB and CPU seconds of this process and its children"""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in KiB on linux and bytes on darwin
+    scale = 1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0
+    return {
+        'peak_rss_mb': round(own.ru_maxrss / scale, 1),
+        'children_peak_rss_mb': round(children.ru_maxrss / scale, 1),
+        'cpu_seconds': round(own.ru_utime + own.ru_stime, 3),
+        'children_cpu_seconds': round(children.ru_utime + children.ru_stime, 3),
+    }
+
+def run_segmented(opts):
+    """Download one file from the local server with each connection count"""
+    from segmented import SegmentedDownloader
+    MediaHandler.rate = opts.connection_rate
+    server, url = start_server()
+    if not opts.json:
+        print('{:>8} {:>12} {:>9} {:>10}'.format('segments', 'bytes', 'seconds', 'MiB/s'))
+    for count in [int(count) for count in opts.segments.split(',')]:
+        handler, path = tempfile.mkstemp(prefix='youtube-extractor-bench-')
+        os.close(handler)
+        started = time.time()
+        downloaded = SegmentedDownloader('{}/{}'.format(url, opts.size), path, count).download()
+        elapsed = time.time() - started
+        assert os.path.getsize(path) == opts.size
+        os.remove(path)
+        result = {'segments': count, 'bytes': downloaded, 'seconds': round(elapsed, 3),
+                  'mib_per_second': round(downloaded / elapsed / 1048576.0, 1)}
+        if opts.json:
+            print(json.dumps(result))
+        else:
+            print('{:>8} {:>12} {:>9} {:>10}'.format(count, downloaded, result['seconds'], result['mib_per_second']))
+    server.shutdown()
+
+def run_scheduler(config):
+    """Push no-op jobs through ThreadingManager"""
+    from extractor import ThreadingManager
+    latencies = []
+    manager = ThreadingManager(config['workers'])
+    manager.start()
+    started = time.time()
+
+    def job(queued_at):
+        latencies.append(time.time() - queued_at)
+    for _ in range(config['urls']):
+        manager.add(job, time.time())
+    manager.join()
+    return time.time() - started, latencies
+
+def run_extractor(config):
+    """Run Extractor against the stub youtube-dl"""
+    import extractor
+    workdir = tempfile.mkdtemp(prefix='youtube-extractor-bench-')
+    trace = os.path.join(workdir, 'trace.jsonl')
+    urls = os.path.join(workdir, 'urls.txt')
+    with open(urls, 'w') as handler:
+        for i in range(config['urls']):
+            handler.write('https://www.youtube.com/watch?v={:011d}\n'.format(i))
+    sys.argv = ['extractor.py', '--with-tor', '--force', '--retries', '0',
+                '-t', str(config['workers']), '--engine', config['engine'], '--batch-size', str(config['batch_size']),
+                '--index', os.path.join(workdir, 'index.db'), '--trace', trace, '-f', urls]
+    opts = extractor.parse_opts()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        started = time.time()
+        extractor.Extractor(opts).run()
+        elapsed = time.time() - started
+    finally:
+        os.chdir(cwd)
+    latencies = []
+    with open(trace) as handler:
+        for line in handler:
+            event = json.loads(line)
+            if event['event'] == 'job':
+                latencies.append(event['seconds'])
+    shutil.rmtree(workdir, ignore_errors=True)
+    return elapsed, latencies
+
+def child(config):
+    """Run one configuration and print its results as JSON"""
+    sys.stdout = open(os.devnull, 'w')
+    if config['scheduler_only']:
+        elapsed, latencies = run_scheduler(config)
+    else:
+        elapsed, latencies = run_extractor(config)
+    sys.stdout = sys.__stdout__
+    result = dict(config)
+    result.update(usage())
+    result.update({
+        'seconds': round(elapsed, 3),
+        'jobs_per_second': round(config['urls'] / elapsed, 1) if elapsed else None,
+        'p50_latency': percentile(latencies, 0.5),
+        'p99_latency': percentile(latencies, 0.99),
+    })
+    print(json.dumps(result))
+
+def main():
+    opts = parse_opts()
+    if opts.child:
+        child(json.loads(opts.child))
+        return
+    if opts.segments:
+        run_segmented(opts)
+        return
+
+    env = dict(os.environ)
+    env['PATH'] = HERE + os.pathsep + env.get('PATH', '')
+    env.update({
+        'FAKE_YTDL_LATENCY': str(opts.latency),
+        'FAKE_YTDL_SIZE': str(opts.size),
+        'FAKE_YTDL_PROGRESS': str(opts.progress),
+        'FAKE_YTDL_FAILURE_RATE': str(opts.failure_rate),
+        # keep probe and identity caches away from the user home
+        'HOME': tempfile.mkdtemp(prefix='youtube-extractor-bench-home-'),
+    })
+    server = None
+    if opts.server:
+        server, env['FAKE_YTDL_MEDIA_URL'] = start_server()
+
+    workers = [int(count) for count in opts.workers.split(',')]
+    engines = ['thread'] if opts.scheduler_only else opts.engine.split(',')
+    if not opts.json:
+        print('{:>8} {:>8} {:>8} {:>9} {:>10} {:>9} {:>9} {:>9} {:>9}'.format(
+            'engine', 'workers', 'urls', 'seconds', 'jobs/s', 'p50', 'p99', 'rss MB', 'cpu s'))
+    for engine, count in itertools.product(engines, workers):
+        config = {'engine': engine, 'workers': count, 'urls': opts.urls, 'batch_size': opts.batch_size,
+                  'scheduler_only': opts.scheduler_only}
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', json.dumps(config)],
+                                env=env, stdout=subprocess.PIPE, check=True).stdout.decode().strip().splitlines()
+        result = json.loads(output[-1])
+        if opts.json:
+            print(json.dumps(result))
+            continue
+        print('{:>8} {:>8} {:>8} {:>9} {:>10} {:>9} {:>9} {:>9} {:>9}'.format(
+            engine, count, opts.urls, result['seconds'], result['jobs_per_second'],
+            '{:.4f}'.format(result['p50_latency']) if result['p50_latency'] is not None else '-',
+            '{:.4f}'.format(result['p99_latency']) if result['p99_latency'] is not None else '-',
+            max(result['peak_rss_mb'], result['children_peak_rss_mb']),
+            round(result['cpu_seconds'] + result['children_cpu_seconds'], 2)))
+    if server:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
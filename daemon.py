@@ -0,0 +1,347 @@
+from logger import *
+from metrics import metrics
+from extractor import Extractor, YoutubeDl, UrlReader, ThreadingManager, signalhandler
+import os
+import json
+import time
+import signal
+import threading
+import collections
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class Job(object):
+    """A video submitted to the daemon"""
+    FINISHED = ('done', 'failed', 'cancelled')
+
+    def __init__(self, video_id, url):
+        self.id = video_id
+        self.url = url
+        self.state = 'queued'
+        self.progress = None
+        self.error = None
+        self.submitted = time.time()
+        self.updated = self.submitted
+        self.version = 0
+
+    @property
+    def finished(self):
+        return self.state in self.FINISHED
+
+    def as_dict(self):
+        progress = self.progress
+        return {
+            'id': self.id,
+            'url': self.url,
+            'state': self.state,
+            'percent': progress.percent if progress else 0.0,
+            'downloaded_bytes': progress.downloaded_bytes if progress else 0,
+            'total_bytes': progress.total_bytes if progress else None,
+            'speed': progress.speed if progress else None,
+            'eta': progress.eta if progress else None,
+            'filename': progress.filename if progress else None,
+            'error': self.error,
+            'submitted': round(self.submitted, 3),
+            'updated': round(self.updated, 3),
+        }
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server listening on a unix socket"""
+    daemon_threads = True
+
+class Daemon(Extractor):
+    """Keep tor, probes and workers warm and take download jobs over a local HTTP API"""
+    MAX_JOBS = 10000
+
+    def __init__(self, opts):
+        super().__init__(opts)
+        self.listen = opts.listen
+        self.jobs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.ydl = YoutubeDl()
+        self.server = None
+
+    def serve(self):
+        """Start the workers and answer requests until interrupted"""
+        signal.signal(signal.SIGTERM, signalhandler)
+        self.ydl.start()
+        self._wait_tor()
+        self._check_identity()
+        if self.transcode_threads > 0:
+            self.transcoder = ThreadingManager(self.transcode_threads, queue_size=self.MAX_JOBS)
+            self.transcoder.start()
+        self.manager = ThreadingManager(self.threads, queue_size=self.MAX_JOBS, throttle=self.throttle)
+        self.manager.start()
+        if self.resume and self.journal:
+            for url in self.journal.unfinished():
+                self.submit(url)
+        try:
+            self.server = self._bind(self.listen)
+            logger.log('[*] Accepting jobs on ' + self.listen, YELLOW)
+            self.server.serve_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop serving, kill running downloads and release every resource"""
+        if self.server:
+            self.server.server_close()
+            if isinstance(self.server, UnixHTTPServer) and os.path.exists(self.listen):
+                os.remove(self.listen)
+        with self.lock:
+            processes = [job.progress.process for job in self.jobs.values() if job.progress and not job.finished]
+        for process in processes:
+            self._terminate(process)
+        self.manager.stop()
+        if self.transcoder:
+            self.transcoder.stop()
+        if self.journal:
+            self.journal.close()
+        self.index.close()
+        if self.pool:
+            self.pool.stop()
+        metrics.close()
+        logger.log('[*] ' + repr(self.download_metrics))
+        logger.flush()
+
+    def submit(self, url):
+        """Queue a url, returning the job already tracking its video when there is one"""
+        video_id = UrlReader.video_id(url)
+        if not video_id:
+            raise ValueError('Not a youtube url: ' + url)
+        url = UrlReader.CANONICAL.format(video_id)
+        with self.lock:
+            job = self.jobs.get(video_id)
+            if job and job.state not in ('failed', 'cancelled'):
+                metrics.inc('daemon_submissions_total', result='coalesced')
+                return job
+            job = Job(video_id, url)
+            self.jobs[video_id] = job
+            self._trim()
+            indexed = not self.force and self._index_key(url) in self.index
+            if indexed:
+                job.state = 'done'
+        if indexed:
+            metrics.inc('daemon_submissions_total', result='indexed')
+            self._close_indexed(url)
+            return job
+        metrics.inc('daemon_submissions_total', result='queued')
+        self._record(url, 'queued')
+        if not self.manager.add(self._run_yotube_dl_service, self.ydl, ([url], 1, time.time())):
+            self._update(url, 'cancelled')
+        return job
+
+    def get(self, video_id):
+        with self.lock:
+            return self.jobs.get(video_id)
+
+    def list(self):
+        with self.lock:
+            return [job.as_dict() for job in self.jobs.values()]
+
+    def cancel(self, video_id):
+        """Cancel a job, killing its youtube-dl process when it is running"""
+        with self.lock:
+            job = self.jobs.get(video_id)
+            if not job or job.finished:
+                return job
+            process = job.progress.process if job.progress else None
+            self._set_state(job, 'cancelled')
+        self._record(job.url, 'cancelled')
+        if process:
+            self._terminate(process)
+        return job
+
+    def stream(self, video_id, write):
+        """Write a job as a JSON line every time it changes, until it finishes"""
+        version = None
+        while True:
+            with self.lock:
+                job = self.jobs.get(video_id)
+                if job and job.version == version:
+                    self.changed.wait(1)
+                if not job:
+                    return
+                version = job.version
+                state = job.as_dict()
+            write(state)
+            if state['state'] in Job.FINISHED:
+                return
+
+    def _parse_urls(self, opts):
+        """Urls come from the API"""
+        return None
+
+    def _run_yotube_dl_service(self, ydl, job):
+        with self.lock:
+            tracked = self.jobs.get(UrlReader.video_id(job[0][0]))
+            if tracked and tracked.state == 'cancelled':
+                return
+            if tracked:
+                self._set_state(tracked, 'running')
+        super()._run_yotube_dl_service(ydl, job)
+
+    def _prepare_job(self, urls, rate=None):
+        circuit, params, progress, started = super()._prepare_job(urls, rate)
+        with self.lock:
+            job = self.jobs.get(UrlReader.video_id(urls[0]))
+            if job:
+                job.progress = progress
+        return circuit, params, progress, started
+
+    def _report_progress(self, progress):
+        super()._report_progress(progress)
+        with self.lock:
+            job = self.jobs.get(UrlReader.video_id(progress.url))
+            if not job:
+                return
+            cancelled = job.state == 'cancelled'
+            self._set_state(job, job.state)
+        # cancelled before youtube-dl was spawned
+        if cancelled and progress.process:
+            self._terminate(progress.process)
+
+    def _finish_job(self, urls, circuit, progress, started):
+        results = super()._finish_job(urls, circuit, progress, started)
+        for job, succeeded in results:
+            if succeeded and self.transcoder and job.filename:
+                self._update(job.url, 'transcoding', expected='running')
+        return results
+
+    def _retries(self, results, attempt):
+        for url, delay in super()._retries(results, attempt):
+            self._update(url, 'queued')
+            yield url, delay
+
+    def _transcode(self, url, filename):
+        self._update(url, 'transcoding')
+        return super()._transcode(url, filename)
+
+    def _job_done(self, url, succeeded, error=None):
+        super()._job_done(url, succeeded, error)
+        self._update(url, 'done' if succeeded else 'failed', error=error)
+
+    def _record(self, url, state):
+        """Journal a state change, cancelled jobs stay cancelled"""
+        job = self.get(UrlReader.video_id(url))
+        if job and job.state == 'cancelled' and state != 'cancelled':
+            return
+        super()._record(url, state)
+
+    def _update(self, url, state, error=None, expected=None):
+        """Move the job of a url to a new state, cancelled jobs stay cancelled"""
+        with self.lock:
+            job = self.jobs.get(UrlReader.video_id(url))
+            if not job or job.state == 'cancelled' or (expected and job.state != expected):
+                return
+            if error:
+                job.error = error
+            self._set_state(job, state)
+
+    def _set_state(self, job, state):
+        """Change a job while holding the lock and wake up progress streams"""
+        job.state = state
+        job.updated = time.time()
+        job.version += 1
+        self.changed.notify_all()
+
+    def _trim(self):
+        """Forget the oldest finished jobs once too many are tracked"""
+        if len(self.jobs) <= self.MAX_JOBS:
+            return
+        for video_id in [video_id for video_id, job in self.jobs.items() if job.finished]:
+            del self.jobs[video_id]
+            if len(self.jobs) <= self.MAX_JOBS:
+                break
+
+    def _bind(self, address):
+        """Listen on host:port or on a unix socket path"""
+        host, _, port = address.rpartition(':')
+        if port.isdigit() and '/' not in address:
+            server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), self._handler())
+        else:
+            if os.path.exists(address):
+                os.remove(address)
+            server = UnixHTTPServer(address, self._handler())
+        server.daemon_threads = True
+        return server
+
+    def _handler(self):
+        daemon = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parts = self._parts()
+                if parts == ['jobs']:
+                    self._reply(200, daemon.list())
+                elif len(parts) == 2 and parts[0] == 'jobs':
+                    self._job(daemon.get(parts[1]))
+                elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'progress':
+                    self._stream(parts[1])
+                else:
+                    self._reply(404, {'error': 'Not found'})
+
+            def do_POST(self):
+                if self._parts() != ['jobs']:
+                    self._reply(404, {'error': 'Not found'})
+                    return
+                try:
+                    body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode() or '{}')
+                    urls = body['urls'] if 'urls' in body else [body['url']]
+                    for url in urls:
+                        if not UrlReader.video_id(url):
+                            raise ValueError('Not a youtube url: ' + url)
+                    jobs = [daemon.submit(url).as_dict() for url in urls]
+                except (ValueError, KeyError, TypeError) as e:
+                    self._reply(400, {'error': str(e)})
+                    return
+                self._reply(202, jobs if 'urls' in body else jobs[0])
+
+            def do_DELETE(self):
+                parts = self._parts()
+                if len(parts) == 2 and parts[0] == 'jobs':
+                    self._job(daemon.cancel(parts[1]))
+                else:
+                    self._reply(404, {'error': 'Not found'})
+
+            def _parts(self):
+                return [part for part in self.path.split('?')[0].split('/') if part]
+
+            def _job(self, job):
+                if job:
+                    self._reply(200, job.as_dict())
+                else:
+                    self._reply(404, {'error': 'No such job'})
+
+            def _stream(self, video_id):
+                if not daemon.get(video_id):
+                    self._reply(404, {'error': 'No such job'})
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.end_headers()
+
+                def write(state):
+                    self.wfile.write((json.dumps(state) + '\n').encode())
+                    self.wfile.flush()
+                try:
+                    daemon.stream(video_id, write)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def _reply(self, code, body):
+                body = (json.dumps(body) + '\n').encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def address_string(self):
+                # unix sockets have no peer address
+                return str(self.client_address[0]) if self.client_address else 'unix'
+
+            def log_message(self, *args):
+                pass
+        return Handler
@@ -8,20 +8,30 @@ __version__ = '1.0'
 __banner__  = 'youtube-extractor v.%s' % __version__ 
 
 from logger import *
+from index import DownloadIndex
+from torpool import TorPool, IdentityCheck
+from metrics import metrics
+from jobqueue import open_queue
+from journal import Journal, JournalLockedException
+from infocache import InfoCache
 from abc import abstractmethod
 from argparse import ArgumentParser, ArgumentError
 import sys
 import os
 import subprocess 
-import itertools
 import time
 import threading
+import queue
+import random
+import heapq
+import collections
+import hashlib
+import tempfile
+import shutil
+import json
 import re
-import ssl
-import socks
-import stem.process
-import urllib.request
 import signal
+import socket
 
 # Detects user platform
 if sys.platform.startswith('win32'):
@@ -32,7 +42,12 @@ else:
     platform = 'linux' 
 
 pyversion = '.'.join(str(minor) for minor in sys.version_info[:2])
-logger = Logger()
+
+IDENTITY_CACHE = '~/.youtube-extractor/identity.json'
+PROBE_CACHE = '~/.youtube-extractor/probes.json'
+PLAYLIST_CACHE = '~/.youtube-extractor/playlists'
+TOR_DATA = '~/.youtube-extractor/tor'
+DOWNLOADER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'downloader', 'axel')
 
 def parse_opts():
     arguments = ArgumentParser(usage='usage: [options] [url...]')
@@ -40,20 +55,53 @@ def parse_opts():
     arguments.add_argument('-a', '--audio', help='Only extract audio.', dest='audio', action='store_true', default=False)
     arguments.add_argument('--audio-quality', help='Audio quality.', dest='audio_quality', type=int, default=0)
     arguments.add_argument('--audio-format', help='Audio format.', dest='audio_format', type=str)
+    arguments.add_argument('--transcode-threads', help='Number of threads converting audio apart from downloads, 0 lets youtube-dl convert it.', dest='transcode_threads', type=int, default=os.cpu_count() or 1)
     arguments.add_argument('-v', '--video', help='Only extract video.', dest='video', action='store_true', default=False)
     arguments.add_argument('--video-quality', help='Video quality.', dest='video_quality', type=int, default=0)
     arguments.add_argument('--video-format', help='Video format.', dest='video_format', type=str)
     arguments.add_argument('-t', help='Number of threads to use.', dest='threads', type=int, default=1)
+    arguments.add_argument('--limit-rate', help='Global download rate split evenly between the workers, in bytes per second (e.g. 500K or 4.2M).', dest='limit_rate', type=str)
+    arguments.add_argument('--max-extractions', help='Maximum number of youtube-dl extractions, playlist listings included, started per minute.', dest='max_extractions', type=int)
+    arguments.add_argument('--retries', help='Number of times a transient failure is retried.', dest='retries', type=int, default=3)
+    arguments.add_argument('--batch-size', help='Number of urls to hand to each youtube-dl process.', dest='batch_size', type=int, default=1)
+    arguments.add_argument('--engine', help='Execution engine for downloads, threads or a single asyncio event loop, not with --queue or --listen.', dest='engine', choices=['thread', 'asyncio'], default='thread')
+    arguments.add_argument('--segments', help='Download each video over this many connections with the built in segmented downloader.', dest='segments', type=int, default=0)
     arguments.add_argument('--with-tor', help='Enable tor. [Experimental]', dest='tor', action='store_false', default=True)
-    arguments.add_argument('-f', help='Read urls from specified file.', dest='file', type=str)
-    arguments.add_argument('url', help='Url to extract data', action='append', nargs='*')
-    return arguments.parse_args()
+    arguments.add_argument('--tor-circuits', help='Launch this many tor instances and spread downloads across them.', dest='tor_circuits', type=int, default=0)
+    arguments.add_argument('--tor-ports', help='Comma separated running tor socks[:control] ports to spread downloads across.', dest='tor_ports', type=str)
+    arguments.add_argument('--tor-check-url', help='Page used to find out the tor exit IP.', dest='tor_check_url', type=str, default='https://check.torproject.org')
+    arguments.add_argument('--trace', help='Append per job phase timings to this file as JSON lines.', dest='trace', type=str)
+    arguments.add_argument('--metrics-port', help='Serve prometheus metrics on this localhost port.', dest='metrics_port', type=int)
+    arguments.add_argument('--listen', help='Run as a daemon accepting jobs on this unix socket path or host:port.', dest='listen', type=str)
+    arguments.add_argument('--queue', help='Shared job queue, a SQLite file or tcp://[token@]host:port of a coordinator. Urls given are added to it.', dest='queue', type=str)
+    arguments.add_argument('--node', help='Name recorded on the queue for jobs handled here, host:pid by default.', dest='node', type=str)
+    arguments.add_argument('--lease', help='Seconds a job from the shared queue is held without a heartbeat.', dest='lease', type=int, default=60)
+    arguments.add_argument('-f', help='Read urls from specified file, use - to read from stdin.', dest='file', type=str)
+    arguments.add_argument('--index', help='Index file of downloaded videos, used to skip them on next runs.', dest='index', type=str, default='~/.youtube-extractor/index.db')
+    arguments.add_argument('--playlist-ttl', help='Seconds the videos of an expanded playlist or channel are cached.', dest='playlist_ttl', type=int, default=21600)
+    arguments.add_argument('--info-cache', help='File caching the metadata of videos between runs, empty to disable.', dest='info_cache', type=str, default='~/.youtube-extractor/info.db')
+    arguments.add_argument('--info-ttl', help='Seconds cached metadata is used, its media urls expire after some hours.', dest='info_ttl', type=int, default=14400)
+    arguments.add_argument('--info-cache-size', help='Maximum size of the metadata cache in MiB.', dest='info_cache_size', type=int, default=256)
+    arguments.add_argument('--schedule', help='Order of jobs: as given, longest or shortest first.', dest='schedule', choices=Scheduler.POLICIES, default='fifo')
+    arguments.add_argument('--schedule-window', help='Number of pending jobs ordered together.', dest='schedule_window', type=int, default=1000)
+    arguments.add_argument('--priority', help='PATTERN=N, jobs from urls containing PATTERN go first when N is higher. Repeatable.', dest='priority', action='append')
+    arguments.add_argument('--prefetch', help='Number of youtube-dl processes fetching unknown durations before ordering jobs.', dest='prefetch', type=int, default=0)
+    arguments.add_argument('--journal', help='Journal of job states, used to resume unfinished jobs after a crash.', dest='journal', type=str, default='~/.youtube-extractor/journal')
+    arguments.add_argument('--continue', help='Resume the unfinished jobs of the journal, reusing partially downloaded files.', dest='resume', action='store_true', default=False)
+    arguments.add_argument('--force', help='Download videos even when they are on the index.', dest='force', action='store_true', default=False)
+    arguments.add_argument('url', help='Url to extract data', nargs='*')
+    opts = arguments.parse_args()
+    if opts.engine == 'asyncio' and (opts.queue or opts.listen):
+        # the shared queue and the daemon hand jobs to the thread engine only
+        arguments.error('--engine asyncio cannot be used with --queue or --listen.')
+    return opts
 
 def signalhandler(singnum, frame):
     """Handle a keyboard interrupt"""
-    logger.log('\n[*] Received user keyboard interrupt.')
-    print('[*] Exiting.')
-    sys.exit()
+    logger.log('[*] Received user keyboard interrupt.')
+    logger.write('[*] Exiting.')
+    logger.flush()
+    sys.exit(128 + singnum)
 
 class ProcessNotKilledException(BaseException):
     def __init__(self, message):
@@ -63,31 +111,431 @@ class ProcessNotKilledException(BaseException):
         return str(self.message)
 
 class Loader(object):
-    """Start an animation"""
+    """Start an animation, drawn by the logger with the status of running jobs"""
     def __init__(self, output=None, message='', sleep=0.1, color=NULL):
         self.output = output if output else ['|', '/', '-', '\\']
         self.message = message
         self.sleep = sleep
         self.color = color
-        self.event = threading.Event()
     
     def start(self):
         """Start the animation output"""
-        self.event.set()
-        def run():
-            time.sleep(0.2)
-            for i in itertools.cycle(self.output):
-                if not self.event.is_set():
-                    break
-                sys.stdout.write('\r' + self.color + self.message + ' ' + i + NULL)
-                sys.stdout.flush()
-                time.sleep(self.sleep)
-
-        threading.Thread(target=run).start()
+        logger.progress(self, self)
     
     def stop(self):
         """Stop animation output"""
-        self.event.clear()
+        logger.finish(self)
+
+    def __str__(self):
+        frame = self.output[int(time.time() / self.sleep) % len(self.output)]
+        return self.color + self.message + ' ' + frame + NULL
+
+class Progress(object):
+    """Download progress of a youtube-dl job, fed line by line"""
+    PATTERN = re.compile(r'^\[download\]\s+(?P<percent>[\d.]+)% of\s+~?(?P<total>[\d.]+\s*[KMGTPE]?i?B)'
+                         r'(?:\s+at\s+(?P<speed>[\d.]+\s*[KMGTPE]?i?B)/s)?(?:\s+ETA\s+(?P<eta>[\d:]+))?')
+    POSTPROCESSORS = ('[ffmpeg]', '[ExtractAudio]', '[Merger]', '[FixupM4a]')
+    FILENAME_PATTERN = re.compile(r'^\[download\] (?:Destination: (.+)|(.+) has already been downloaded)$')
+    INFO_PATTERN = re.compile(r'^\[info\] Writing video (?:description )?metadata as JSON to: (.+)$')
+    UNITS = {'B': 1, 'KIB': 1024, 'MIB': 1024 ** 2, 'GIB': 1024 ** 3, 'TIB': 1024 ** 4,
+             'KB': 1000, 'MB': 1000 ** 2, 'GB': 1000 ** 3, 'TB': 1000 ** 4}
+
+    def __init__(self, url=None):
+        self.url = url
+        self.percent = 0.0
+        self.total_bytes = None
+        self.downloaded_bytes = 0
+        self.speed = None
+        self.eta = None
+        self.returncode = None
+        self.process = None
+        self.errors = collections.deque(maxlen=10)
+        self.last_line = ''
+        self.filename = None
+        self.info_filename = None
+        self.loaded_info = None
+        self.timings = {}
+
+    def mark(self, name):
+        """Remember when a phase was first reached"""
+        if name not in self.timings:
+            self.timings[name] = time.time()
+
+    def update(self, line):
+        """Parse an output line, return True when it carried progress"""
+        line = line.strip()
+        if not line:
+            return False
+        self.last_line = line
+        if line.startswith('ERROR:'):
+            self.errors.append(line)
+            return False
+        if line.startswith(self.POSTPROCESSORS):
+            self.mark('postprocess')
+            return False
+        match = self.INFO_PATTERN.match(line)
+        if match:
+            self.info_filename = match.group(1)
+            return False
+        match = self.FILENAME_PATTERN.match(line)
+        if match:
+            self.mark('download')
+            self.filename = next(name for name in match.groups() if name)
+            return False
+        match = self.PATTERN.match(line)
+        if not match:
+            return False
+        self.mark('download')
+        self.percent = float(match.group('percent'))
+        self.total_bytes = self._to_bytes(match.group('total'))
+        if self.total_bytes is not None:
+            self.downloaded_bytes = int(self.total_bytes * self.percent / 100)
+        self.speed = self._to_bytes(match.group('speed'))
+        self.eta = self._to_seconds(match.group('eta'))
+        return True
+
+    @property
+    def succeeded(self):
+        """Indicate wheter the process exited cleanly"""
+        return self.returncode == 0
+
+    def error(self):
+        """Describe why the job failed"""
+        if self.errors:
+            return '\n'.join(self.errors)
+        return self.last_line
+
+    def __repr__(self):
+        return '{} {:.1f}% of {} bytes at {} B/s ETA {}s'.format(self.url, self.percent, self.total_bytes, self.speed, self.eta)
+
+    def _to_bytes(self, size):
+        """Convert a youtube-dl size like 1.50MiB to bytes"""
+        if not size:
+            return None
+        match = re.match(r'([\d.]+)\s*([KMGTPE]?i?B)', size)
+        if not match or match.group(2).upper() not in self.UNITS:
+            return None
+        return int(float(match.group(1)) * self.UNITS[match.group(2).upper()])
+
+    def _to_seconds(self, eta):
+        """Convert a youtube-dl ETA like 01:02:03 to seconds"""
+        if not eta:
+            return None
+        seconds = 0
+        for part in eta.split(':'):
+            seconds = seconds * 60 + int(part)
+        return seconds
+
+class ProbeCache(object):
+    """Remember services found available, keyed on the binary path and mtime"""
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.lock = threading.Lock()
+        self.probes = None
+
+    def get(self, binary):
+        """Indicate wheter the binary was probed successfully since it last changed"""
+        with self.lock:
+            return self._load().get(binary) == self._mtime(binary)
+
+    def set(self, binary):
+        """Record a successful probe of the binary"""
+        with self.lock:
+            self._load()[binary] = self._mtime(binary)
+            directory = os.path.dirname(self.path)
+            try:
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                with open(self.path + '.tmp', 'w') as handler:
+                    json.dump(self.probes, handler)
+                os.replace(self.path + '.tmp', self.path)
+            except OSError as e:
+                logger.log('[-] Could not save probe cache: ' + str(e), RED)
+
+    def _load(self):
+        """Read the cache file once"""
+        if self.probes is None:
+            try:
+                with open(self.path) as handler:
+                    self.probes = json.load(handler)
+            except (OSError, ValueError):
+                self.probes = {}
+        return self.probes
+
+    def _mtime(self, binary):
+        try:
+            return os.stat(binary).st_mtime
+        except OSError:
+            return None
+
+probes = ProbeCache(PROBE_CACHE)
+
+class BatchProgress(object):
+    """Progress of a youtube-dl process downloading several videos in sequence"""
+    VIDEO_PATTERN = re.compile(r'^\[youtube\] (?P<id>[\w-]{11}): ')
+
+    def __init__(self, urls):
+        self.jobs = collections.OrderedDict((UrlReader.video_id(url), Progress(url)) for url in urls)
+        self.started = []
+        self.returncode = None
+        self.process = None
+        self.last_line = ''
+        self.timings = {}
+
+    def mark(self, name):
+        """Remember when a phase was first reached by any video"""
+        if name not in self.timings:
+            self.timings[name] = time.time()
+
+    @property
+    def url(self):
+        return ' '.join(job.url for job in self.jobs.values())
+
+    @property
+    def current(self):
+        """Progress of the video being downloaded"""
+        return self.jobs[self.started[-1]] if self.started else None
+
+    @property
+    def downloaded_bytes(self):
+        return sum(job.downloaded_bytes for job in self.jobs.values())
+
+    @property
+    def succeeded(self):
+        return all(succeeded for job, succeeded in self.results())
+
+    def update(self, line):
+        """Parse an output line on behalf of the video being downloaded"""
+        self.last_line = line.strip() or self.last_line
+        match = self.VIDEO_PATTERN.match(line.strip())
+        if match and match.group('id') in self.jobs and match.group('id') not in self.started:
+            self.started.append(match.group('id'))
+        if not self.current:
+            return False
+        updated = self.current.update(line)
+        for name in self.current.timings:
+            self.mark(name)
+        return updated
+
+    def results(self):
+        """Return the progress of every video with whether it was downloaded"""
+        results = []
+        # with --ignore-errors youtube-dl exits 1 when any video failed, the last
+        # one is only to blame when no video reported why
+        reported = self.returncode == 1 and any(job.errors for job in self.jobs.values())
+        for video_id, job in self.jobs.items():
+            if job.errors or video_id not in self.started:
+                job.returncode = job.returncode or self.returncode or 1
+            elif self.returncode == 0 or video_id != self.started[-1] or reported:
+                job.returncode = 0
+            else:
+                job.returncode = self.returncode
+            results.append((job, job.succeeded))
+        return results
+
+    def error(self):
+        """Describe why the videos failed"""
+        return '\n'.join('{}: {}'.format(job.url, job.error()) for job in self.jobs.values() if not job.succeeded) or self.last_line
+
+    def __repr__(self):
+        return repr(self.current) if self.current else self.url
+
+class StageMetrics(object):
+    """Thread safe counters of a pipeline stage"""
+    def __init__(self, name):
+        self.name = name
+        self.jobs = 0
+        self.failures = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, seconds, succeeded, downloaded_bytes=0):
+        """Account a finished job"""
+        with self.lock:
+            self.jobs += 1
+            self.failures += 0 if succeeded else 1
+            self.seconds += seconds
+            self.bytes += downloaded_bytes
+
+    def __repr__(self):
+        with self.lock:
+            elapsed = max(time.time() - self.started, 1e-6)
+            return '{}: {} jobs, {} failed, {:.1f}s busy, {:.2f} jobs/s, {:.0f} B/s'.format(
+                self.name, self.jobs, self.failures, self.seconds, self.jobs / elapsed, self.bytes / elapsed)
+
+class RetryPolicy(object):
+    """Tell transient from permanent youtube-dl failures and how long to wait before a retry"""
+    THROTTLED = re.compile(r'HTTP Error 429|Too Many Requests', re.I)
+    PERMANENT = re.compile(r'HTTP Error 404|Video unavailable|is not available|private video|This video is private|'
+                           r'removed|copyright|account associated with this video has been terminated|'
+                           r'confirm your age|not a valid URL|Unsupported URL|members-only', re.I)
+    # youtube-dl exits with 2 on invalid options
+    PERMANENT_CODES = (2,)
+
+    def __init__(self, retries=3, base=2.0, cap=300.0):
+        self.retries = retries
+        self.base = base
+        self.cap = cap
+
+    def classify(self, progress):
+        """Return throttled, permanent or transient for a failed job"""
+        error = progress.error() or ''
+        if self.THROTTLED.search(error):
+            return 'throttled'
+        if progress.returncode in self.PERMANENT_CODES or self.PERMANENT.search(error):
+            return 'permanent'
+        return 'transient'
+
+    def delay(self, attempt):
+        """Exponential backoff with full jitter, attempt starts at 1"""
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+class Throttle(object):
+    """AIMD concurrency window, halved when throttled and grown back by successes"""
+    def __init__(self, maximum, minimum=1, cooldown=10):
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.cooldown = cooldown
+        self.window = float(self.maximum)
+        self.active = 0
+        self.decreased_at = 0.0
+        self.condition = threading.Condition()
+
+    @property
+    def limit(self):
+        return int(self.window)
+
+    def acquire(self):
+        """Wait for a free slot in the window"""
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def success(self):
+        """Grow the window by about one slot per window of successes"""
+        with self.condition:
+            if self.window < self.maximum:
+                self.window = min(self.maximum, self.window + 1.0 / self.window)
+                self.condition.notify_all()
+
+    def throttled(self):
+        """Halve the window, at most once per cooldown"""
+        with self.condition:
+            if time.time() - self.decreased_at < self.cooldown:
+                return
+            self.decreased_at = time.time()
+            self.window = max(self.minimum, self.window / 2)
+            logger.log('[*] Throttled, running {} downloads at once.'.format(self.limit), YELLOW)
+
+class TokenBucket(object):
+    """Token bucket refilled at rate tokens per second, it may go in debt"""
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.time()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, tokens):
+        """Seconds until tokens are available"""
+        self.refill()
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+class RateLimiter(object):
+    """Global bandwidth and extraction rate budget shared by every worker and circuit"""
+    def __init__(self, bytes_per_second=None, extractions_per_minute=None, concurrency=1):
+        self.bytes_per_second = bytes_per_second
+        self.concurrency = max(1, concurrency)
+        # a second of burst for bandwidth, ten seconds worth of extractions
+        self.bandwidth = TokenBucket(bytes_per_second, bytes_per_second) if bytes_per_second else None
+        self.extractions = TokenBucket(extractions_per_minute / 60.0, max(1, extractions_per_minute // 6)) if extractions_per_minute else None
+        self.active = 0
+        self.accounted = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def parse_rate(rate):
+        """Parse a rate like 500K or 4.2M to bytes per second"""
+        if not rate:
+            return None
+        match = re.match(r'^([\d.]+)\s*([kmgt]?)i?b?$', rate.strip(), re.I)
+        if not match:
+            raise ArgumentError(None, 'Invalid rate: ' + rate)
+        return int(float(match.group(1)) * 1024 ** ' kmgt'.index(match.group(2).lower() or ' '))
+
+    def start(self, extractions=1):
+        """Wait until a job extracting that many videos may start, return its --limit-rate share"""
+        while True:
+            delay = self._try_start(extractions)
+            if delay is None:
+                return self._share()
+            time.sleep(delay)
+
+    async def start_async(self, extractions=1):
+        """Same as start, without blocking the event loop"""
+        import asyncio
+        while True:
+            delay = self._try_start(extractions)
+            if delay is None:
+                return self._share()
+            await asyncio.sleep(delay)
+
+    def account(self, progress):
+        """Charge the bandwidth budget with the bytes a job downloaded since last call"""
+        if not self.bandwidth:
+            return
+        with self.lock:
+            downloaded = progress.downloaded_bytes
+            self.bandwidth.refill()
+            self.bandwidth.tokens -= max(0, downloaded - self.accounted.get(id(progress), 0))
+            self.accounted[id(progress)] = downloaded
+
+    def finish(self, progress):
+        """Release the share of a finished job"""
+        self.account(progress)
+        with self.lock:
+            self.active -= 1
+            self.accounted.pop(id(progress), None)
+
+    def _try_start(self, extractions):
+        """Take a token per extraction and a slot, or return how long to wait"""
+        with self.lock:
+            delay = 0.0
+            if self.bandwidth:
+                # do not start new jobs while the budget is overdrawn
+                delay = max(delay, self.bandwidth.wait_time(0))
+            if self.extractions:
+                # batches larger than the bucket start once it is full and leave it in debt
+                delay = max(delay, self.extractions.wait_time(min(extractions, self.extractions.capacity)))
+            if delay > 0:
+                return delay
+            if self.extractions:
+                self.extractions.tokens -= extractions
+            self.active += 1
+            return None
+
+    def _share(self):
+        """Split of the bandwidth budget between the most jobs that can run at once, their sum never goes over it
+
+        youtube-dl reads --limit-rate once when it starts, a running job cannot take the share of a finished one.
+        Splitting between the jobs running instead would overdraw the budget as soon as more jobs start, the price
+        is a budget partly unused while the last jobs of a run drain.
+        """
+        if not self.bytes_per_second:
+            return None
+        return max(1, self.bytes_per_second // self.concurrency)
 
 class Service(object):
     """Service manager"""
@@ -135,18 +583,39 @@ class Service(object):
             stdout, stderr = (b'', b'Process timed out.')
 
         if root and 'incorrect' in stderr.decode().lower():
-            return '', 'Incorrect password.'
-        
-        output, errors = self._parse_output(stdout, stderr)
+            output, errors = '', 'Incorrect password.'
+        else:
+            output, errors = self._parse_output(stdout, stderr)
         if pid:
             return output, errors, process.pid
         return output, errors
 
+    def stream_process(self, command, progress, callback=None):
+        """Run a process without shell, feeding every output line to progress as it arrives"""
+        logger.log('[*] Running: ' + ' '.join(command), YELLOW)
+        progress.mark('spawn')
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+        progress.process = process
+        progress.mark('spawned')
+        for line in process.stdout:
+            if progress.update(line.decode(errors='replace')) and callback:
+                callback(progress)
+        process.stdout.close()
+        progress.returncode = process.wait()
+        progress.mark('exit')
+        return progress
+
     def check_availability(self, command):
         """Check if service is available on user system"""
-        stderr = self.execute_process(command if type(command) is list else [command])[1]
+        command = command if type(command) is list else [command]
+        binary = shutil.which(command[0].split(' ')[0])
+        if binary and probes.get(binary):
+            return True
+        stderr = self.execute_process(command)[1]
         
         if stderr and ( 'usage' in stderr.lower() or 'Process timed out' in stderr ):
+            if binary:
+                probes.set(binary)
             return True
         return False
 
@@ -164,7 +633,7 @@ class Service(object):
 
 class YoutubeDl(Service):
     """Use youtube-dl wonderfull script to execute content download"""
-    def start(self, *args):
+    def start(self, *args, callback=None, progress=None):
         """Run youtube-dl script on process"""
         logger.log('[*] Running youtube-dl service.')
         command = ['youtube-dl']
@@ -175,35 +644,68 @@ class YoutubeDl(Service):
                 available = self.check_availability(command)
                 if available:
                     self.installed = True
+                    break
                 else:
                     logger.log('[*] Error: Service is not available on system.')
                     self._install()
                     self.tried_to_install = True
                 
         if self.tried_to_install and not self.installed:
-            print('[*] Tried to install youtube-dl with no success.')
-            print('[-] Exiting.')
+            logger.write('[*] Tried to install youtube-dl with no success.')
+            logger.write('[-] Exiting.')
             sys.exit()
         
-        if args:
-            command.append(*args)
-        error = self.execute_process([' '.join(command)], timeout=None)[1]
-        if error and not 'help' in error.lower():
-            logger.log('[*] Error output: '+ error, RED)
-            return False
-        return True
+        if not args:
+            return True
+        progress = self.stream_process(command + ['--newline'] + list(args), progress if progress else Progress(args[-1]), callback)
+        return self._check_progress(progress)
+
+    async def start_async(self, *args, callback=None, progress=None):
+        """Run youtube-dl on an asyncio subprocess, without a shell"""
+        import asyncio
+        command = ['youtube-dl', '--newline'] + list(args)
+        progress = progress if progress else Progress(args[-1])
+        logger.log('[*] Running: ' + ' '.join(command), YELLOW)
+        progress.mark('spawn')
+        process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.STDOUT, stdin=asyncio.subprocess.DEVNULL)
+        progress.process = process
+        progress.mark('spawned')
+        try:
+            while True:
+                line = await process.stdout.readline()
+                if not line:
+                    break
+                if progress.update(line.decode(errors='replace')) and callback:
+                    callback(progress)
+            progress.returncode = await process.wait()
+        except asyncio.CancelledError:
+            # the loop is shutting down, do not leave youtube-dl running behind it
+            if process.returncode is None:
+                process.terminate()
+                await process.wait()
+            raise
+        progress.mark('exit')
+        return self._check_progress(progress)
 
     def restart(self, *args):
         """Just pass arguments to start method"""
         return self.start(*args)
 
+    def _check_progress(self, progress):
+        """Indicate wheter youtube-dl finished without errors"""
+        if not progress.succeeded:
+            logger.log('[*] Error output ({}): {}'.format(progress.returncode, progress.error()), RED)
+            return False
+        return True
+
     def _install(self):
         """Try to install youtube-dl with python"""
         loader = Loader(message='[*] Installing youtube-dl', color=YELLOW)
         command = ['-H python' + pyversion + ' -m pip install youtube-dl']
         error = self.execute_process(command, root=True, loader=loader)[1]
         if error:
-            logger.log('\n[-] Error: '+ error, RED)
+            logger.log('[-] Error: '+ error, RED)
             logger.log('[*] Last command failed.')
             if platform == 'darwin':
                 command = ['HOMEBREW_NO_AUTO_UPDATE=1 brew install youtube-dl']
@@ -213,29 +715,59 @@ class YoutubeDl(Service):
                 error = self.execute_process(command, timeout=None, root=True)[1]
         loader.stop()
         if error:
-            logger.log('\n[*] Error installing: '+ error, RED)
-            print('[*] Could not install youtube-dl.')
-            print('[+] See: https://rg3.github.io/youtube-dl')
+            logger.log('[*] Error installing: '+ error, RED)
+            logger.write('[*] Could not install youtube-dl.')
+            logger.write('[+] See: https://rg3.github.io/youtube-dl')
             sys.exit()
-        logger.log('\n[*] youtube-dl has been installed.', color=GREEN)
+        logger.log('[*] youtube-dl has been installed.', color=GREEN)
+
+class FFmpeg(Service):
+    """Use ffmpeg to convert downloaded audio, apart from the download workers"""
+    CODECS = {'mp3': 'libmp3lame', 'aac': 'aac', 'm4a': 'aac', 'opus': 'libopus', 'vorbis': 'libvorbis',
+              'flac': 'flac', 'wav': 'pcm_s16le'}
+    EXTENSIONS = {'vorbis': 'ogg'}
+
+    def start(self, source, audio_format, quality=None):
+        """Convert source to audio_format, return the converted file or None"""
+        target = os.path.splitext(source)[0] + '.' + self.EXTENSIONS.get(audio_format, audio_format)
+        if target == source:
+            return target
+        command = ['ffmpeg', '-y', '-loglevel', 'error', '-i', source, '-vn', '-codec:a', self.CODECS.get(audio_format, audio_format)]
+        if quality is not None and audio_format not in ('flac', 'wav'):
+            # same quality scale youtube-dl uses for --audio-quality
+            command.extend(['-q:a', str(quality)] if quality < 10 else ['-b:a', '{}k'.format(quality)])
+        command.append(target)
+        logger.log('[*] Running: ' + ' '.join(command), YELLOW)
+        try:
+            process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL)
+        except OSError as e:
+            logger.log('[-] Could not run ffmpeg: ' + str(e), RED)
+            return None
+        if process.returncode != 0:
+            logger.log('[*] Error output ({}): {}'.format(process.returncode, process.stderr.decode(errors='replace').strip()), RED)
+            return None
+        os.remove(source)
+        return target
 
 class Tor(Service):
     """Start a tor proxy on user machine"""
-    def __init__(self):
+    def __init__(self, identity=None, port=9050):
         self.started = False
         self.tried_to_install = False
         self.installed = False
         self.ip = None
-        self.socket_patched = False
         self.pid = None
+        self.port = port
+        self.identity = identity if identity else IdentityCheck()
 
-    def start(self):
-        """Start tor"""
+    def start(self, install=True):
+        """Start tor, install it and restart the script when it is missing unless install is False"""
         pid = self._is_process_running()
-        print('{}Tor is our new feature. Here we start tor on port 9050 and use the proxy server.'.format(GREEN))
-        print('The downloads will pass through tor network and download the file without tracking(we wish!)')
+        logger.write('Tor is our new feature. Here we start tor on port 9050 and use the proxy server.', GREEN)
+        logger.write('The downloads will pass through tor network and download the file without tracking(we wish!)', GREEN)
         if self.started or pid:
             self.pid = pid
+            self.started = True
             logger.log('[*] Service already started.')
             return True
        
@@ -243,12 +775,15 @@ class Tor(Service):
         if not self.started:
             if not self._start_in_background(): 
                 logger.log('[*] Error: Service is not available on system.', RED)
+                if not install:
+                    return False
                 self._install()  
                 # auto restart script
+                logger.flush()
                 os.execv(sys.executable, [sys.executable] + sys.argv)
 
         if not self.installed and self.tried_to_install:
-            print(RED +'[-] Could not run or install tor.'+ NULL)
+            logger.write('[-] Could not run or install tor.', RED)
             return False
         return True
 
@@ -277,7 +812,7 @@ class Tor(Service):
 
         # kill any remaining process
         self._kill_process()
-        self.socket_patched = False
+        self.identity.invalidate(self.port)
         self.pid = None
         self.ip = None
         self.started = False
@@ -294,16 +829,19 @@ class Tor(Service):
             logger.log('[*] Tor service already running.')
         
         if platform == 'linux':
-            errors, pid = self.execute_process(['systemctl start tor'], root=True, pid=True)[0:]
+            errors, pid = self.execute_process(['systemctl start tor'], root=True, pid=True)[1:]
             if not errors:
                 logger.log('[*] Started tor on systemctl interface.', YELLOW)
                 self.pid = pid
                 self.started = True
+                self.identity.invalidate(self.port)
                 return True
         try:
+            import stem.process
             process = stem.process.launch_tor()
             self.pid = process.pid
             self.started = True
+            self.identity.invalidate(self.port)
         except OSError:
             logger.log('[-] Failed to start tor.', RED)
             return False
@@ -321,22 +859,22 @@ class Tor(Service):
             error = self.execute_process(command, timeout=None, root=True)[1]
         else:
             loader.stop()
-            print('\n[-] You are using Windows. No available installers.')
-            print('[+] See: https://rg3.github.io/youtube-dl')
+            logger.write('[-] You are using Windows. No available installers.')
+            logger.write('[+] See: https://rg3.github.io/youtube-dl')
             sys.exit()
         loader.stop()
         if error:
-            logger.log('\n[*] Error installing: '+ error, RED)
-            print('[*] Could not install tor.')
-            print('[+] See: https://rg3.github.io/youtube-dl')
+            logger.log('[*] Error installing: '+ error, RED)
+            logger.write('[*] Could not install tor.')
+            logger.write('[+] See: https://rg3.github.io/youtube-dl')
             sys.exit()
         self.tried_to_install = True
-        logger.log('\n[*] tor has been installed.', color=GREEN)
+        logger.log('[*] tor has been installed.', color=GREEN)
 
     def _is_process_running(self):
         """Determine wheter there is a tor process running."""
         if platform == 'windows':
-            command = ['netstat -ano | findstr :9050']
+            command = ['netstat -ano | findstr :{}'.format(self.port)]
             output = self.execute_process(command)[0]
             if output:
                 output = ' '.join([e for e in output.split(' ') if e])
@@ -344,7 +882,7 @@ class Tor(Service):
                 if len(pid) > 0:
                     return pid[0]
         elif platform == 'darwin':
-            command = ['lsof -i tcp:9050']
+            command = ['lsof -i tcp:{}'.format(self.port)]
             output = self.execute_process(command)[0]
             if output:
                 output = ' '.join([e for e in output.split(' ') if e])
@@ -352,7 +890,14 @@ class Tor(Service):
                 if len(pid) > 0:
                     return pid[0]
         else:
-            command = ['netstat -nlp | grep 9050']
+            inode = self._listening_inode()
+            if inode is None:
+                return False
+            pid = self._find_socket_owner(inode)
+            if pid:
+                return pid
+            # the owner is not visible to us, ask netstat as root
+            command = ['netstat -nlp | grep {}'.format(self.port)]
             output = self.execute_process(command, root=True)[0]
             if output:
                 pid = re.findall(r"(\d+)\/[a-zA-Z]+", output)
@@ -360,6 +905,38 @@ class Tor(Service):
                     return pid[0]
         return False
 
+    def _listening_inode(self):
+        """Read /proc/net/tcp to find the socket inode listening on tor port"""
+        for table in ('/proc/net/tcp', '/proc/net/tcp6'):
+            try:
+                with open(table) as handler:
+                    lines = handler.readlines()[1:]
+            except OSError:
+                continue
+            for line in lines:
+                fields = line.split()
+                # state 0A is TCP_LISTEN
+                if len(fields) > 9 and fields[3] == '0A' and int(fields[1].rsplit(':', 1)[1], 16) == self.port:
+                    return fields[9]
+        return None
+
+    def _find_socket_owner(self, inode):
+        """Find the pid of the tor process holding a socket inode"""
+        target = 'socket:[{}]'.format(inode)
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            try:
+                with open('/proc/{}/comm'.format(pid)) as handler:
+                    if handler.read().strip() != 'tor':
+                        continue
+                for fd in os.listdir('/proc/{}/fd'.format(pid)):
+                    if os.readlink('/proc/{}/fd/{}'.format(pid, fd)) == target:
+                        return pid
+            except OSError:
+                continue
+        return None
+
     def _kill_process(self):
         """Handle the process being executed on tor default port and kill it"""
         if self.started and self.pid:
@@ -389,25 +966,7 @@ class Tor(Service):
         """Set tor service IP"""
         if self.started:
             logger.log('[*] Checking if tor is running and get relay ip. It can take a while...', YELLOW)
-            if not self.socket_patched:
-                # use monkey patching method to pass default proxy through socket
-                socks.set_default_proxy(socks.SOCKS5, '127.0.0.1', 9050)
-                socks.wrapmodule(urllib.request)
-                self.socket_patched = True
-            context = ssl.create_default_context(purpose=ssl.Purpose.CLIENT_AUTH)
-            response = urllib.request.urlopen('https://check.torproject.org', context=context).read()
-            if 'Congratulations. This browser is configured to use Tor' in response.decode():
-                ip = re.findall(r'Your IP address appears to be\:  \<strong\>(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})', response.decode())
-                if len(ip) is 0:
-                    print(RED + '[-] Something on check tor website changed and we was unable to determine our IP.')
-                    print('[-] Please report a issue https://github.com/yanmarques/youtube-extractor/issues.')
-                    print('[*] We will be now trying to get out IP on another aproach.' + NULL)
-                    ip = urllib.request.urlopen('http://www.icanhazip.com').read()
-                    self.ip = ip.decode().strip()
-                else:
-                    self.ip = ip[0]
-            else:
-                raise Exception('Could not bind tor proxy on socket.')
+            self.ip = self.identity.lookup(self.port)
         else:
             raise Exception('Tor service not started. Unable to get indentity')
 
@@ -415,23 +974,505 @@ class Extractor(object):
     """Extract video/audio from youtube urls with threading."""
     def __init__(self, opts):
         self.opts = opts
+        self.tor = None
+        metrics.configure(opts.trace, opts.metrics_port)
+        self.identity = IdentityCheck(opts.tor_check_url, path=IDENTITY_CACHE)
+        self.transcode_threads = opts.transcode_threads if opts.audio else 0
+        self.journal = self._open_journal(opts.journal)
+        self.resume = opts.resume
         self.params = self._parse_opt(opts)
+        self.output = self._requested_output(opts)
+        self.limiter = RateLimiter(RateLimiter.parse_rate(opts.limit_rate), opts.max_extractions, opts.threads)
         self.urls = self._parse_urls(opts)
-        self.tor = None
         self.threads = opts.threads
+        self.engine = opts.engine
+        self.batch_size = max(1, opts.batch_size)
+        self.segments = opts.segments
+        if self.segments > 0:
+            # youtube-dl looks the external downloader up on the PATH
+            os.environ['PATH'] = os.path.dirname(DOWNLOADER) + os.pathsep + os.environ.get('PATH', '')
+        self.retry = RetryPolicy(opts.retries)
+        self.throttle = Throttle(self.threads)
+        self.manager = None
+        self.transcoder = None
+        self.ffmpeg = FFmpeg()
+        self.download_metrics = StageMetrics('download')
+        self.transcode_metrics = StageMetrics('transcode')
+        self.pool = None
+        self.index = DownloadIndex(opts.index)
+        self.infos = InfoCache(opts.info_cache, opts.info_ttl, opts.info_cache_size * 1024 * 1024) if opts.info_cache else None
+        # prefetched metadata lands in the info cache, it is needed to prefetch
+        self.scheduler = Scheduler(opts.schedule, opts.schedule_window, Scheduler.parse_priorities(opts.priority),
+                                   estimate=self._estimate, prefetch=self._prefetch if opts.prefetch > 0 and self.infos else None)
+        self.force = opts.force
+        self.queue = open_queue(opts.queue) if opts.queue else None
+        self.node = opts.node or '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.lease = max(1, opts.lease)
+        self.held = set()
+        self.held_lock = threading.Lock()
+        # circuit that prefetched the metadata of a url, its media urls only work from that exit IP
+        self.pinned = {}
+        # progress of the youtube-dl processes running, killed when the run stops
+        self.running = set()
+        self.running_lock = threading.Lock()
+        self.stopped = False
+        # bootstrap tor while youtube-dl is probed
+        self.startup_error = None
+        self.startup = threading.Thread(target=self._start_tor)
+        self.startup.daemon = True
+        self.startup.start()
 
-    def run(self, with_overlapping=True):
-        manager = ThreadingManager(self.threads)
+    def run(self):
         ydl = YoutubeDl()
         ydl.start()
-        print(self.tor.get_ip())
-        for url in self.urls:
-            manager.add(self._run_yotube_dl_service, ydl, url)
-        manager.start()
-        print(GREEN + '[+] Download finished.' + NULL)
+        self._wait_tor()
+        self._check_identity()
+        if self.transcode_threads > 0:
+            self.transcoder = ThreadingManager(self.transcode_threads)
+            self.transcoder.start()
+        heartbeat = self._start_heartbeat() if self.queue else None
+        try:
+            if self.queue:
+                self.queue.put(self._pending_urls())
+            if self.engine == 'asyncio':
+                self.manager = AsyncManager(self.threads, self.throttle)
+                self.manager.run(self._run_yotube_dl_service_async, ydl, self._batches())
+            else:
+                self._run_with_threads(ydl)
+            if self.transcoder:
+                self.transcoder.join()
+        finally:
+            self._stop_running()
+            if self.transcoder:
+                self.transcoder.stop()
+            if heartbeat:
+                heartbeat.set()
+            if self.journal:
+                self.journal.close()
+            if self.infos:
+                self.infos.close()
+            self.index.close()
+            if self.pool:
+                self.pool.stop()
+            metrics.close()
+        logger.log('[*] ' + repr(self.download_metrics))
+        if self.queue:
+            for node, state, count in self.queue.stats():
+                logger.log('[*] Queue: {} {} by {}'.format(count, state, node))
+            self.queue.close()
+        if self.transcoder:
+            logger.log('[*] ' + repr(self.transcode_metrics))
+        logger.write('[+] Download finished.', GREEN)
+        logger.flush()
+
+    def _check_identity(self):
+        """Look up tor exit IPs in background while downloads start"""
+        ports = [circuit.socks_port for circuit in self.pool.circuits] if self.pool else []
+        if self.tor and self.tor.started:
+            ports.append(self.tor.port)
+        if ports:
+            self.identity.start(ports, callback=self._report_identity)
+
+    def _report_identity(self, port, ip):
+        """Print the exit IP of a circuit"""
+        logger.write('[*] Tor exit IP on port {}: {}'.format(port, ip))
+
+    def _pending_urls(self):
+        """Yield the urls that are not on the download index, in scheduling order"""
+        for url in self.scheduler.order(self._pending_entries()):
+            self._record(url, 'queued')
+            yield url
+
+    def _pending_entries(self):
+        """Yield url, source and duration of the urls to download"""
+        if not self.urls:
+            return
+        for url, source, duration in self.urls.entries():
+            if not self.force and self._index_key(url) in self.index:
+                logger.log('[*] Already downloaded: ' + url)
+                self._close_indexed(url)
+                continue
+            if self.resume and self.journal and self.journal.state(url) in ('failed', 'cancelled'):
+                logger.log('[*] Failed on a previous run: ' + url)
+                continue
+            yield url, source, duration
+
+    def _estimate(self, url):
+        """Duration of a video known from metadata of earlier downloads"""
+        return self.infos.duration(UrlReader.video_id(url)) if self.infos else None
+
+    def _prefetch(self, urls):
+        """Fetch the metadata of videos in parallel so they can be ordered, it is reused by their downloads"""
+        logger.log('[*] Fetching metadata of {} videos.'.format(len(urls)), YELLOW)
+        with metrics.phase('prefetch', videos=len(urls)):
+            prefetcher = ThreadingManager(self.opts.prefetch)
+            prefetcher.start()
+            for url in urls:
+                prefetcher.add(self._prefetch_info, url)
+            prefetcher.join()
+
+    def _prefetch_info(self, url):
+        command = ['youtube-dl', '--dump-json', '--no-check-certificate']
+        circuit = random.choice(self.pool.circuits) if self.pool and self.pool.circuits else None
+        if circuit:
+            command.extend(['--proxy', circuit.proxy])
+        progress = Progress(url)
+        self.limiter.start()
+        try:
+            process = subprocess.run(command + [url], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL)
+        finally:
+            self.limiter.finish(progress)
+        if process.returncode == 0 and process.stdout.strip():
+            self.infos.put(self._info_key(url, circuit), process.stdout.strip())
+            if circuit:
+                self.pinned[url] = circuit
+
+    def _index_key(self, url):
+        return DownloadIndex.key(UrlReader.video_id(url), self.output)
+
+    def _batches(self):
+        """Group pending urls in jobs of batch size, each job is a tuple of urls and attempt"""
+        if self.queue:
+            yield from self._claimed_batches()
+            return
+        batch = []
+        for url in self._pending_urls():
+            batch.append(url)
+            if len(batch) >= self.batch_size:
+                yield batch, 1, time.time()
+                batch = []
+        if batch:
+            yield batch, 1, time.time()
+
+    def _claimed_batches(self):
+        """Lease jobs from the shared queue until no node has any left"""
+        while True:
+            urls = self.queue.claim(self.node, self.batch_size, self.lease)
+            if not urls:
+                with self.held_lock:
+                    held = len(self.held)
+                # leases of other nodes may expire and be delivered again
+                if not held and not self.queue.pending():
+                    return
+                time.sleep(min(5, self.lease / 3.0))
+                continue
+            with self.held_lock:
+                self.held.update(urls)
+            batch = []
+            for url in urls:
+                if not self.force and self._index_key(url) in self.index:
+                    logger.log('[*] Already downloaded: ' + url)
+                    self._job_done(url, True)
+                else:
+                    self._record(url, 'queued')
+                    batch.append(url)
+            if batch:
+                yield batch, 1, time.time()
+
+    def _start_heartbeat(self):
+        """Keep the leases of held jobs alive, return the event stopping it"""
+        stopped = threading.Event()
+
+        def beat():
+            while not stopped.wait(self.lease / 3.0):
+                with self.held_lock:
+                    held = list(self.held)
+                if not held:
+                    continue
+                try:
+                    self.queue.heartbeat(self.node, held, self.lease)
+                except Exception as e:
+                    logger.log('[-] Heartbeat failed: ' + repr(e), RED)
+        worker = threading.Thread(target=beat)
+        worker.daemon = True
+        worker.start()
+        return stopped
+
+    def _job_done(self, url, succeeded, error=None):
+        """A url reached its final outcome, journal it and hand it back to the shared queue"""
+        self._record(url, 'done' if succeeded else 'failed')
+        if not self.queue:
+            return
+        with self.held_lock:
+            self.held.discard(url)
+        self.queue.complete(self.node, url, succeeded, error)
+
+    def _run_with_threads(self, ydl):
+        """Feed every job to the worker pool"""
+        self.manager = ThreadingManager(self.threads, throttle=self.throttle)
+        self.manager.start()
+        try:
+            for job in self._batches():
+                if not self.manager.add(self._run_yotube_dl_service, ydl, job):
+                    break
+            self.manager.join()
+        finally:
+            self.manager.stop()
+
+    def _run_yotube_dl_service(self, ydl, job):
+        urls, attempt, queued_at = job
+        metrics.record('queue_wait', time.time() - queued_at, job=' '.join(urls))
+        circuit, params, progress, started = self._prepare_job(urls, self.limiter.start(len(urls)))
+        for url in urls:
+            self._record(url, 'running')
+        with self.running_lock:
+            self.running.add(progress)
+        try:
+            ydl.start(*params, *urls, callback=self._report_progress, progress=progress)
+        finally:
+            with self.running_lock:
+                self.running.discard(progress)
+            self.limiter.finish(progress)
+        for url, delay in self._retries(self._finish_job(urls, circuit, progress, started), attempt):
+            self.manager.requeue(self._run_yotube_dl_service, ydl, ([url], attempt + 1, time.time() + delay), delay=delay)
+
+    async def _run_yotube_dl_service_async(self, ydl, job):
+        import asyncio
+        urls, attempt, queued_at = job
+        metrics.record('queue_wait', time.time() - queued_at, job=' '.join(urls))
+        circuit, params, progress, started = self._prepare_job(urls, await self.limiter.start_async(len(urls)))
+        for url in urls:
+            self._record(url, 'running')
+        with self.running_lock:
+            self.running.add(progress)
+        try:
+            await ydl.start_async(*params, *urls, callback=self._report_progress, progress=progress)
+        finally:
+            with self.running_lock:
+                self.running.discard(progress)
+            self.limiter.finish(progress)
+        # handing files to the transcode stage may block on its queue
+        results = await asyncio.get_running_loop().run_in_executor(None, self._finish_job, urls, circuit, progress, started)
+        for url, delay in self._retries(results, attempt):
+            self.manager.requeue(([url], attempt + 1, time.time() + delay), delay=delay)
+
+    def _retries(self, results, attempt):
+        """Adjust concurrency to the outcome of a job and yield the urls to retry with their delay"""
+        if self.stopped:
+            # killed on stop, the journal keeps them running so --continue picks them up
+            return
+        for job, succeeded in results:
+            if succeeded:
+                self.throttle.success()
+                continue
+            kind = self.retry.classify(job)
+            metrics.inc('errors_total', kind=kind)
+            if kind == 'throttled':
+                self.throttle.throttled()
+            if kind == 'permanent' or attempt > self.retry.retries:
+                logger.log('[-] Giving up on {} after {} attempts.'.format(job.url, attempt), RED)
+                self._job_done(job.url, False, job.error())
+                continue
+            delay = self.retry.delay(attempt)
+            logger.log('[*] Retrying {} in {:.1f}s ({}).'.format(job.url, delay, kind), YELLOW)
+            self._record(job.url, 'queued')
+            yield job.url, delay
+
+    def _stop_running(self):
+        """Terminate the youtube-dl processes still running, their .part files are kept for --continue"""
+        self.stopped = True
+        with self.running_lock:
+            processes = [progress.process for progress in self.running if progress.process]
+        for process in processes:
+            self._terminate(process)
+
+    def _terminate(self, process):
+        if process.returncode is None:
+            try:
+                process.terminate()
+            except ProcessLookupError:
+                pass
+
+    def _prepare_job(self, urls, rate=None):
+        """Pick a tor circuit for a job and build its youtube-dl parameters"""
+        params = list(self.params)
+        if self.resume:
+            # pick up the .part files left by the interrupted run, kept off the index key
+            params.append('--continue')
+        if rate:
+            params.extend(['--limit-rate', str(rate)])
+        pinned = [self.pinned.pop(url, None) for url in urls]
+        # a batch does not load cached metadata, it needs no pinned circuit
+        circuit = self.pool.acquire(pinned[0] if len(urls) == 1 else None) if self.pool else None
+        if circuit:
+            params.extend(['--proxy', circuit.proxy])
+        if self.segments > 0:
+            params.extend(['--external-downloader', DOWNLOADER,
+                           '--external-downloader-args', self._downloader_args(rate, circuit)])
+        loaded = None
+        if len(urls) > 1:
+            params.append('--ignore-errors')
+            progress = BatchProgress(urls)
+        else:
+            # a youtube-dl run loads the metadata of a single video only
+            progress = Progress(urls[0])
+            progress.loaded_info = loaded = self._load_info(urls[0], circuit)
+        if loaded:
+            params.extend(['--load-info-json', loaded])
+        elif self.infos:
+            params.append('--write-info-json')
+        return circuit, params, progress, time.time()
 
-    def _run_yotube_dl_service(self, ydl, url):
-        ydl.start(' '.join(self.params) + ' {}'.format(url))
+    def _downloader_args(self, rate, circuit):
+        """Arguments of the segmented downloader, media urls only work from the circuit that extracted them"""
+        args = ['-n', str(self.segments), '-k']
+        if rate:
+            args.extend(['-s', str(rate)])
+        if circuit:
+            args.extend(['--proxy', circuit.proxy])
+        return ' '.join(args)
+
+    def _info_key(self, url, circuit):
+        """Media urls of the metadata only work from the IP that extracted it"""
+        return UrlReader.video_id(url) + (' ' + circuit.proxy if circuit else '')
+
+    def _load_info(self, url, circuit):
+        """Write the cached metadata of a video to a file for youtube-dl, return its path"""
+        if not self.infos:
+            return None
+        info = self.infos.get(self._info_key(url, circuit))
+        metrics.inc('info_cache_total', result='hit' if info else 'miss')
+        if not info:
+            return None
+        handler, path = tempfile.mkstemp(prefix='youtube-extractor-', suffix='.info.json')
+        with os.fdopen(handler, 'wb') as handler:
+            handler.write(info)
+        return path
+
+    def _cache_info(self, job, circuit, succeeded):
+        """Keep the metadata written by youtube-dl, forget cached metadata that failed"""
+        if job.loaded_info:
+            os.remove(job.loaded_info)
+            if not succeeded:
+                # expired media urls, the retry extracts again
+                self.infos.invalidate(self._info_key(job.url, circuit))
+        elif job.info_filename and os.path.isfile(job.info_filename):
+            if succeeded:
+                with open(job.info_filename, 'rb') as handler:
+                    self.infos.put(self._info_key(job.url, circuit), handler.read())
+            os.remove(job.info_filename)
+
+    def _finish_job(self, urls, circuit, progress, started):
+        """Record the outcome of a job, returning whether each url succeeded"""
+        seconds = time.time() - started
+        logger.finish(progress)
+        if circuit:
+            self.pool.release(circuit, progress.downloaded_bytes, seconds, progress.succeeded)
+        self.download_metrics.record(seconds, progress.succeeded, progress.downloaded_bytes)
+        self._record_phases(progress)
+        results = progress.results() if len(urls) > 1 else [(progress, progress.succeeded)]
+        for job, succeeded in results:
+            metrics.inc('jobs_total', status='succeeded' if succeeded else 'failed')
+            if self.infos:
+                self._cache_info(job, circuit, succeeded)
+        metrics.inc('downloaded_bytes_total', progress.downloaded_bytes)
+        metrics.observe('job_seconds', seconds)
+        metrics.event('job', seconds=round(seconds, 6), job=progress.url, succeeded=progress.succeeded)
+        for job, succeeded in results:
+            if succeeded and self.transcoder and job.filename:
+                self.transcoder.add(self._transcode, job.url, job.filename)
+            elif succeeded:
+                self.index.add(self._index_key(job.url))
+                self._job_done(job.url, True)
+        return results
+
+    def _record_phases(self, progress):
+        """Split the life of a youtube-dl process in phases"""
+        timings = progress.timings
+        job = progress.url
+        if 'spawned' not in timings:
+            return
+        end = timings.get('exit', time.time())
+        metrics.record('spawn', timings['spawned'] - timings['spawn'], job=job)
+        if 'download' in timings:
+            metrics.record('extraction', timings['download'] - timings['spawned'], job=job)
+            metrics.record('download', timings.get('postprocess', end) - timings['download'], job=job,
+                           bytes=progress.downloaded_bytes)
+        else:
+            metrics.record('extraction', end - timings['spawned'], job=job)
+        if 'postprocess' in timings:
+            metrics.record('postprocess', end - timings['postprocess'], job=job, stage='youtube-dl')
+
+    def _transcode(self, url, filename):
+        """Convert a downloaded file to the requested audio format"""
+        started = time.time()
+        target = self.ffmpeg.start(filename, self.opts.audio_format or 'mp3', self.opts.audio_quality)
+        metrics.record('postprocess', time.time() - started, url=url, stage='transcode')
+        self.transcode_metrics.record(time.time() - started, target is not None)
+        if target:
+            self.index.add(self._index_key(url))
+        self._job_done(url, target is not None, None if target else 'Unable to convert ' + filename)
+        return target is not None
+
+    def _report_progress(self, progress):
+        """Show download progress of a job in the status of running jobs"""
+        self.limiter.account(progress)
+        logger.progress(progress, progress)
+
+    def _parse_urls(self, opts):
+        """Retrive all urls from options, unfinished jobs of the journal come first when resuming"""
+        urls = list(opts.url)
+        if opts.resume and self.journal:
+            unfinished = self.journal.unfinished()
+            logger.log('[*] Resuming {} unfinished jobs.'.format(len(unfinished)), YELLOW)
+            urls = unfinished + urls
+        if opts.queue and not urls and not opts.file:
+            # only work on jobs already on the shared queue
+            return []
+        if opts.resume and not urls and not opts.file:
+            return []
+        expander = PlaylistExpander(PLAYLIST_CACHE, opts.playlist_ttl, proxy=self._expansion_proxy, limiter=self.limiter)
+        return UrlReader(urls, opts.file, expander=expander)
+
+    def _expansion_proxy(self):
+        """Expand playlists through one of the tor circuits when there are some"""
+        if self.pool and self.pool.circuits:
+            return random.choice(self.pool.circuits).proxy
+        return None
+
+    def _open_journal(self, path):
+        """Open the job journal, going on without one when another run holds it"""
+        if not path:
+            return None
+        try:
+            return Journal(path)
+        except JournalLockedException as e:
+            logger.log('[-] {}, jobs of this run will not be resumable.'.format(e), RED)
+            return None
+
+    def _record(self, url, state):
+        if self.journal:
+            self.journal.record(url, state)
+
+    def _close_indexed(self, url):
+        """Journal an indexed url as done, a crash between indexing and journaling left it unfinished"""
+        if self.journal and self.journal.state(url):
+            self._record(url, 'done')
+
+    def _start_tor(self):
+        """Start tor or build the tor circuit pool when asked for, on the startup thread"""
+        try:
+            with metrics.phase('tor_setup'):
+                if self.tor:
+                    # installing tor restarts the script, that is left to the main thread
+                    self.tor.start(install=False)
+                elif self.opts.tor_ports:
+                    self.pool = TorPool.attach(self.opts.tor_ports.split(','), identity=self.identity)
+                elif self.opts.tor_circuits > 0:
+                    self.pool = TorPool.launch(self.opts.tor_circuits, directory=TOR_DATA, identity=self.identity)
+        except Exception as e:
+            self.startup_error = e
+
+    def _wait_tor(self):
+        """Wait for the startup thread, exit rather than download without the tor asked for"""
+        self.startup.join()
+        error = self.startup_error
+        if not error and self.tor and not self.tor.started and not self.tor.start():
+            error = 'tor is not running'
+        if error:
+            logger.write('[-] Could not set up tor: {}'.format(error), RED)
+            logger.flush()
+            sys.exit(1)
 
     def _parse_opt(self, opts):
         """Parse user options"""
@@ -444,98 +1485,505 @@ class Extractor(object):
         if opts.verbose:
             logger.set_verbose()
 
-        if opts.audio:
+        if opts.audio and self.transcode_threads > 0:
+            # download only, audio is converted by the transcode stage
+            params.extend(['-f', 'bestaudio/best'])
+        elif opts.audio:
             params.append('-x')
-            params.append('--audio-quality ' + str(opts.audio_quality))
-            params.append('--audio-format ' + (opts.audio_format if opts.audio_format else 'mp3'))
+            params.extend(['--audio-quality', str(opts.audio_quality)])
+            params.extend(['--audio-format', opts.audio_format if opts.audio_format else 'mp3'])
         elif opts.video:
             params.append('-f')
-            params.append('--video-quality ' + str(opts.video_quality))
-            params.append('--video-format ' + (opts.video_format if opts.video_format else 'mp4'))
+            params.extend(['--video-quality', str(opts.video_quality)])
+            params.extend(['--video-format', opts.video_format if opts.video_format else 'mp4'])
         params.append('--no-check-certificate')
 
-        if opts.tor:
-            # Start tor
-            self.tor = Tor()
-            self.tor.start()
+        if opts.tor and not opts.tor_ports and opts.tor_circuits <= 0:
+            self.tor = Tor(self.identity)
 
         return params
 
-    def _parse_urls(self, opts):
-        """Retrive all urls from options"""
-        if opts.file:
-            path = os.path.normpath(opts.file)
-            if os.path.isfile(path):
-                with open(path, 'rb') as handler:
-                    urls = handler.read().decode().split('\n');
-                    for index, url in enumerate(urls):
-                        if not re.match(r'^(https?\:\/\/)?(www\.)?(youtube\.com|youtu\.?be)\/watch\?v\=.+$', url):
-                            logger.log('[-] Skipping URL: ' + url)
-                            del urls[index]
-                    opts.url = urls
+    def _requested_output(self, opts):
+        """Describe the files asked for, the same output is one index entry however youtube-dl is called"""
+        if opts.audio:
+            return ['audio', opts.audio_format or 'mp3', str(opts.audio_quality)]
+        if opts.video:
+            return ['video', opts.video_format or 'mp4', str(opts.video_quality)]
+        return ['best']
+
+class UrlReader(object):
+    """Lazily read youtube urls, yielding each video once in its canonical form"""
+    PATTERN = re.compile(r'^(?:https?://)?(?:www\.|m\.)?(?:youtube\.com/(?:watch\?(?:.*&)?v=|embed/|shorts/)|youtu\.be/)(?P<id>[\w-]{11})')
+    PLAYLIST_PATTERN = re.compile(r'^(?:https?://)?(?:www\.|m\.)?youtube\.com/'
+                                  r'(?:playlist\?(?:.*&)?list=[\w-]+|(?:channel|c|user)/[\w.-]+|@[\w.-]+)')
+    CANONICAL = 'https://www.youtube.com/watch?v={}'
+
+    def __init__(self, urls=None, path=None, max_seen=1000000, expander=None):
+        self.urls = urls if urls else []
+        self.path = path
+        self.max_seen = max_seen
+        self.expander = expander
+        if path and path != '-' and not os.path.isfile(os.path.normpath(path)):
+            raise ArgumentError(None, 'File does not exist: ' + path)
+        if not self.urls and not path:
+            raise ArgumentError(None, 'No urls specified.')
+
+    def __iter__(self):
+        for url, source, duration in self.entries():
+            yield url
+
+    def entries(self):
+        """Yield the canonical url of every video with the url it came from and its duration when known"""
+        seen = collections.OrderedDict()
+        for video_id, source, duration in self._video_ids():
+            if video_id in seen:
+                seen.move_to_end(video_id)
+                continue
+            seen[video_id] = None
+            if len(seen) > self.max_seen:
+                seen.popitem(last=False)
+            yield self.CANONICAL.format(video_id), source, duration
+
+    @classmethod
+    def video_id(cls, url):
+        """Return the video id of a youtube url or None"""
+        match = cls.PATTERN.match(url)
+        return match.group('id') if match else None
+
+    @classmethod
+    def is_playlist(cls, url):
+        """Indicate wheter the url is a playlist or a channel"""
+        return cls.PLAYLIST_PATTERN.match(url) is not None
+
+    def _video_ids(self):
+        """Yield the video id, source and duration of every url, playlists are expanded as youtube-dl lists them"""
+        for url in self._read():
+            video_id = self.video_id(url)
+            if video_id:
+                yield video_id, url, None
+            elif self.expander and self.is_playlist(url):
+                for video_id, duration in self.expander.expand(url):
+                    yield video_id, url, duration
             else:
-                raise ArgumentError('-f', 'File does not exist') 
-        if len(opts.url) == 0:
-            raise ArgumentError('No urls specified.', 'url')  
-        return opts.url    
+                logger.log('[-] Skipping URL: ' + url)
+
+    def _read(self):
+        """Yield raw urls from arguments then from file or stdin, line by line"""
+        for url in self.urls:
+            yield url.strip()
+        if not self.path:
+            return
+        if self.path == '-':
+            for line in sys.stdin:
+                if line.strip():
+                    yield line.strip()
+            return
+        with open(os.path.normpath(self.path), 'r', errors='replace') as handler:
+            for line in handler:
+                if line.strip():
+                    yield line.strip()
+
+class Scheduler(object):
+    """Order jobs by source priority then by estimated duration, window jobs at a time"""
+    POLICIES = ('fifo', 'longest', 'shortest')
+
+    def __init__(self, policy='fifo', window=1000, priorities=None, estimate=None, prefetch=None):
+        self.policy = policy
+        self.window = max(1, window)
+        self.priorities = priorities if priorities else []
+        self.estimate = estimate
+        self.prefetch = prefetch
+
+    @staticmethod
+    def parse_priorities(values):
+        """Parse PATTERN=N options to a list of pattern and priority"""
+        priorities = []
+        for value in values or []:
+            pattern, _, priority = value.rpartition('=')
+            try:
+                priorities.append((pattern, int(priority)))
+            except ValueError:
+                raise ArgumentError(None, 'Invalid priority: ' + value)
+            if not pattern:
+                raise ArgumentError(None, 'Invalid priority: ' + value)
+        return priorities
+
+    def priority(self, url, source):
+        """Priority of the first pattern found in the source or in the video url"""
+        for pattern, priority in self.priorities:
+            if pattern in source or pattern in url:
+                return priority
+        return 0
+
+    def order(self, entries):
+        """Yield the url of every url, source and duration entry in scheduling order"""
+        if self.policy == 'fifo' and not self.priorities:
+            for url, source, duration in entries:
+                yield url
+            return
+        window = []
+        for entry in entries:
+            window.append(entry)
+            if len(window) >= self.window:
+                yield from self._sorted(window)
+                window = []
+        if window:
+            yield from self._sorted(window)
+
+    def _sorted(self, window):
+        """Sort a window, jobs of unknown duration count as the average of the others"""
+        durations = []
+        if self.policy != 'fifo':
+            durations = [duration if duration else self._estimate(url) for url, source, duration in window]
+            unknown = [url for (url, source, duration), estimate in zip(window, durations) if estimate is None]
+            if unknown and self.prefetch:
+                self.prefetch(unknown)
+                durations = [estimate if estimate else self._estimate(url) for (url, source, duration), estimate in zip(window, durations)]
+        known = [duration for duration in durations if duration is not None]
+        average = sum(known) / len(known) if known else 0.0
+        sign = -1 if self.policy == 'longest' else 1
+        jobs = []
+        for position, (url, source, duration) in enumerate(window):
+            cost = durations[position] if durations and durations[position] is not None else average
+            jobs.append((-self.priority(url, source), sign * cost if durations else 0, position, url))
+        jobs.sort()
+        logger.log('[*] Ordered {} jobs, {} with a known duration.'.format(len(jobs), len(known)))
+        for job in jobs:
+            yield job[-1]
+
+    def _estimate(self, url):
+        return self.estimate(url) if self.estimate else None
+
+class PlaylistExpander(object):
+    """Resolve playlist and channel urls to video ids from youtube-dl flat JSON output, caching them for ttl seconds"""
+    def __init__(self, path, ttl, proxy=None, limiter=None):
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self.proxy = proxy
+        self.limiter = limiter
+
+    def expand(self, url):
+        """Yield video ids and durations while youtube-dl is still listing the rest"""
+        videos = self._cached(url)
+        if videos is not None:
+            logger.log('[*] Using {} cached videos of {}'.format(len(videos), url))
+            for video_id, duration in videos:
+                yield video_id, duration
+            return
+        command = ['youtube-dl', '--flat-playlist', '--dump-json']
+        proxy = self.proxy() if self.proxy else None
+        if proxy:
+            command.extend(['--proxy', proxy])
+        # listing a playlist is an extraction of its own
+        progress = Progress(url)
+        if self.limiter:
+            self.limiter.start()
+        logger.log('[*] Expanding: ' + url, YELLOW)
+        started = time.time()
+        videos = []
+        process = subprocess.Popen(command + [url], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+        try:
+            for line in process.stdout:
+                line = line.decode(errors='replace').strip()
+                if line.startswith('ERROR:'):
+                    logger.log('[-] ' + line, RED)
+                if not line.startswith('{'):
+                    continue
+                entry = json.loads(line)
+                if entry.get('ie_key', 'Youtube') == 'Youtube' and entry.get('id'):
+                    videos.append((entry['id'], entry.get('duration')))
+                    yield videos[-1]
+                elif entry.get('url') and UrlReader.is_playlist(entry['url']):
+                    # channel tabs list playlists of their own
+                    for video in self.expand(entry['url']):
+                        videos.append(video)
+                        yield video
+        finally:
+            # stopped early, youtube-dl is not needed anymore
+            if process.poll() is None:
+                process.kill()
+            process.stdout.close()
+            if self.limiter:
+                self.limiter.finish(progress)
+        if process.wait() == 0:
+            self._store(url, videos)
+        metrics.record('playlist_expansion', time.time() - started, url=url, videos=len(videos))
+
+    def _file(self, url):
+        return os.path.join(self.path, hashlib.sha1(url.encode()).hexdigest()[:16] + '.json')
+
+    def _cached(self, url):
+        """Return the video ids and durations of a playlist expanded less than ttl seconds ago"""
+        try:
+            with open(self._file(url)) as handler:
+                cached = json.load(handler)
+        except (OSError, ValueError):
+            return None
+        if cached.get('url') != url or 'videos' not in cached or time.time() - cached.get('expanded_at', 0) > self.ttl:
+            return None
+        return cached['videos']
+
+    def _store(self, url, videos):
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            with open(self._file(url) + '.tmp', 'w') as handler:
+                json.dump({'url': url, 'expanded_at': time.time(), 'videos': videos}, handler, separators=(',', ':'))
+            os.replace(self._file(url) + '.tmp', self._file(url))
+        except OSError as e:
+            logger.log('[-] Could not cache playlist: ' + str(e), RED)
+
+class AsyncManager(object):
+    """Run coroutine jobs on a single event loop, bounded by a semaphore"""
+    def __init__(self, concurrencies, throttle=None):
+        self.concurrencies = max(1, concurrencies)
+        self.throttle = throttle
+        self.executed = 0
+        self.retries = collections.deque()
+        self.delayed = 0
+        self.wakeup = None
+        # items pulled by the feeder thread, it stays at most concurrencies items ahead
+        self.pulled = collections.deque()
+        self.slots = threading.Semaphore(self.concurrencies)
+        self.exhausted = False
+        self.error = None
+
+    def run(self, function, *args):
+        """Call function for every item of the last argument and wait for all of them"""
+        import asyncio
+        *args, items = args
+        asyncio.run(self._run(function, args, items))
+
+    def requeue(self, item, delay=0):
+        """Queue an item again after delay seconds, it runs before the remaining items"""
+        import asyncio
+        if not delay:
+            self.retries.append(item)
+            return
+        self.delayed += 1
+
+        def ready():
+            self.delayed -= 1
+            self.retries.append(item)
+            self.wakeup.set()
+        asyncio.get_running_loop().call_later(delay, ready)
+
+    async def _run(self, function, args, items):
+        """Start a job per item, never more than concurrencies at once"""
+        import asyncio
+        semaphore = asyncio.Semaphore(self.concurrencies)
+        self.wakeup = asyncio.Event()
+        tasks = set()
+        feeder = threading.Thread(target=self._feed, args=(asyncio.get_running_loop(), items))
+        feeder.daemon = True
+        feeder.start()
+        while True:
+            if self.throttle and len(tasks) >= self.throttle.limit:
+                await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                continue
+            await semaphore.acquire()
+            item = None
+            if self.retries:
+                item = self.retries.popleft()
+            elif self.pulled:
+                item = self.pulled.popleft()
+                self.slots.release()
+            if self.error:
+                semaphore.release()
+                raise self.error
+            if item is None:
+                semaphore.release()
+                if self.exhausted and not tasks and not self.delayed:
+                    break
+                # running jobs may still requeue items, the feeder and delayed ones wake us up
+                self.wakeup.clear()
+                waiter = asyncio.ensure_future(self.wakeup.wait())
+                await asyncio.wait(tasks | {waiter}, return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+                continue
+            task = asyncio.ensure_future(self._guard(semaphore, function, *args, item))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    def _feed(self, loop, items):
+        """Pull items on a thread, reading them may block on a file, stdin or youtube-dl"""
+        try:
+            for item in items:
+                self.slots.acquire()
+                if not self._hand(loop, self.pulled.append, item):
+                    return
+        except Exception as e:
+            self._hand(loop, setattr, self, 'error', e)
+            return
+        self._hand(loop, setattr, self, 'exhausted', True)
+
+    def _hand(self, loop, function, *args):
+        """Run function on the event loop and wake it up, False once the loop is closed"""
+        def call():
+            function(*args)
+            self.wakeup.set()
+        try:
+            loop.call_soon_threadsafe(call)
+        except RuntimeError:
+            return False
+        return True
+
+    async def _guard(self, semaphore, function, *args):
+        """Run a job and release its semaphore slot"""
+        try:
+            await function(*args)
+        except Exception as e:
+            logger.log('[-] Job failed: ' + repr(e), RED)
+        finally:
+            self.executed += 1
+            semaphore.release()
 
 class ThreadingManager(object):
-    """Manage concurrencie running threads"""
-    def __init__(self, concurrencies, with_overlapping=True):
-        self.concurrencies = concurrencies
-        self.threads = []
-        self.started = 0
+    """Run jobs on a fixed pool of worker threads fed by a bounded queue"""
+    def __init__(self, concurrencies, queue_size=None, throttle=None):
+        self.concurrencies = max(1, concurrencies)
+        self.throttle = throttle
+        self.delayed = []
+        self.timer = None
+        # producers wait on free slots, requeued jobs skip them so workers never block
+        self.slots = threading.Semaphore(queue_size if queue_size else self.concurrencies * 2)
+        self.queue = queue.Queue()
+        self.workers = []
+        self.added = 0
         self.executed = 0
-        self.overlap = with_overlapping
-        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.cancelled = threading.Event()
+        self.closed = False
 
     def add(self, function, *args):
-        """"Add a thread to manager"""
-        self.threads.append(threading.Thread(target=self._wrap_function, args=(function, *args)))
+        """Queue a job, blocking while the queue is full"""
+        if self.cancelled.is_set():
+            return False
+        self.slots.acquire()
+        self._put(function, args, True)
+        return True
+
+    def requeue(self, function, *args, delay=0):
+        """Queue a job again from inside a running job, without blocking"""
+        if self.cancelled.is_set():
+            return False
+        if not delay:
+            self._put(function, args, False)
+            return True
+        with self.lock:
+            self.added += 1
+            self.finished.clear()
+            heapq.heappush(self.delayed, (time.time() + delay, id(args), function, args))
+            if not self.timer:
+                self.timer = threading.Condition(self.lock)
+                worker = threading.Thread(target=self._release_delayed)
+                worker.daemon = True
+                worker.start()
+            self.timer.notify()
+        return True
 
     def start(self):
-        """Started all threads in concurrency mode"""
-        if self.concurrencies >= len(self.threads):
-            for thread in self.threads:
-                thread.start()
-                thread.join()
-        else:
-            self.event.set()
-            for thread in self.threads[:self.concurrencies]:
-                thread.start()
-                thread.join()    
-                self.started += 1
-            self._manage_threads()
+        """Start the worker threads"""
+        for _ in range(self.concurrencies):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def join(self):
+        """Wait until every queued job has been executed"""
+        with self.lock:
+            self.closed = True
+            if self.added == self.executed:
+                self.finished.set()
+        self.finished.wait()
+        self._shutdown()
 
     def stop(self):
-        """Stop all registered threads"""
-        self.event.clear()
-
-    def _wrap_function(self, function, *args):
-        """Wrap the callback on thread function"""
-        function(*args)
-        self.executed += 1
-
-    def _manage_threads(self):
-        """Manage all registered threads to overlap each one or run in sequence"""
-        while self.event.is_set():
-            if len(self.threads) == self.executed:
-                self.stop()
-                continue
-            if self.overlap:
-                if self.executed - self.started >= 0:
-                    end = self.executed - self.started if self.concurrencies - (self.executed - self.started) <= 0 else self.concurrencies
-                    for thread in self.threads[self.started:self.started + end]:
-                        thread.start()
-                        self.started += 1
-            else:
-                if self.started == self.executed:
-                    for thread in self.threads[self.started:self.started + self.concurrencies]:
-                        thread.start()
-                        self.started += 1
+        """Cancel pending jobs and release the workers"""
+        if self.finished.is_set() and not self.workers:
+            return
+        self.cancelled.set()
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                self._take(item)
+                with self.lock:
+                    self.added -= 1
+        with self.lock:
+            self.added -= len(self.delayed)
+            self.delayed = []
+            if self.timer:
+                self.timer.notify()
+            self.closed = True
+            if self.added == self.executed:
+                self.finished.set()
+        self._shutdown()
+
+    def _release_delayed(self):
+        """Move delayed jobs to the queue once they are due"""
+        with self.lock:
+            while not self.cancelled.is_set():
+                if not self.delayed:
+                    self.timer.wait()
+                    continue
+                due = self.delayed[0][0] - time.time()
+                if due > 0:
+                    self.timer.wait(due)
+                    continue
+                _, _, function, args = heapq.heappop(self.delayed)
+                self.queue.put((function, args, False))
+
+    def _put(self, function, args, bounded):
+        """Account and enqueue a job"""
+        with self.lock:
+            self.added += 1
+            self.finished.clear()
+        self.queue.put((function, args, bounded))
+
+    def _take(self, item):
+        """Free the queue slot held by a job"""
+        if item[2]:
+            self.slots.release()
+
+    def _shutdown(self):
+        """Wake every worker with a sentinel so it can exit"""
+        for _ in self.workers:
+            self.queue.put(None)
+        self.workers = []
+
+    def _work(self):
+        """Worker loop, pull jobs until a sentinel is received"""
+        while True:
+            item = self.queue.get()
+            if item is None or self.cancelled.is_set():
+                return
+            self._take(item)
+            function, args = item[:2]
+            if self.throttle:
+                self.throttle.acquire()
+            try:
+                function(*args)
+            except Exception as e:
+                logger.log('[-] Job failed: ' + repr(e), RED)
+            finally:
+                if self.throttle:
+                    self.throttle.release()
+                with self.lock:
+                    self.executed += 1
+                    if self.closed and self.added == self.executed:
+                        self.finished.set()
 
 if __name__ == '__main__':
     signal.signal(signal.SIGINT, signalhandler)
     opts = parse_opts()
-    extractor = Extractor(opts)
-    extractor.run()
\ No newline at end of file
+    if opts.listen:
+        from daemon import Daemon
+        Daemon(opts).serve()
+    else:
+        extractor = Extractor(opts)
+        extractor.run()
@@ -0,0 +1,46 @@
+import os
+import sqlite3
+import hashlib
+import threading
+
+class DownloadIndex(object):
+    """Persistent index of downloaded videos, keyed by video id and download parameters"""
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS downloads ('
+                                'video_id TEXT NOT NULL, params TEXT NOT NULL, '
+                                'finished_at REAL DEFAULT (julianday(\'now\')), '
+                                'PRIMARY KEY (video_id, params))')
+        self.connection.commit()
+        self.entries = set(self.connection.execute('SELECT video_id, params FROM downloads'))
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def key(video_id, params):
+        """Build the index key of a video downloaded with the given parameters"""
+        return video_id, hashlib.sha1(' '.join(params).encode()).hexdigest()[:16]
+
+    def add(self, key):
+        """Record a finished download, safe to call from any worker"""
+        with self.lock:
+            if key in self.entries:
+                return
+            self.connection.execute('INSERT OR IGNORE INTO downloads (video_id, params) VALUES (?, ?)', key)
+            self.connection.commit()
+            self.entries.add(key)
+
+    def close(self):
+        """Close the database connection"""
+        with self.lock:
+            self.connection.close()
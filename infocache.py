@@ -0,0 +1,106 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import threading
+
+class InfoCache(object):
+    """Compressed youtube-dl info JSON of videos, expired after ttl seconds and trimmed least recently used first"""
+    def __init__(self, path, ttl=14400, max_bytes=256 * 1024 * 1024):
+        self.path = os.path.expanduser(path)
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # losing the last entries on a crash only costs an extraction
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS infos ('
+                                'key TEXT PRIMARY KEY, info BLOB NOT NULL, size INTEGER NOT NULL, '
+                                'fetched_at REAL NOT NULL, used_at REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS infos_used ON infos (used_at)')
+        # durations do not expire, they order jobs long after the info is gone
+        self.connection.execute('CREATE TABLE IF NOT EXISTS durations (video_id TEXT PRIMARY KEY, duration REAL NOT NULL)')
+        self.connection.commit()
+        self.size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM infos').fetchone()[0]
+
+    def get(self, key):
+        """Return the info JSON bytes of key, or None when missing or expired"""
+        with self.lock:
+            row = self.connection.execute('SELECT info, fetched_at FROM infos WHERE key = ?', (key,)).fetchone()
+            if not row:
+                return None
+            if time.time() - row[1] > self.ttl:
+                self._delete(key)
+                self.connection.commit()
+                return None
+            self.connection.execute('UPDATE infos SET used_at = ? WHERE key = ?', (time.time(), key))
+            self.connection.commit()
+        return zlib.decompress(row[0])
+
+    def put(self, key, info):
+        """Store the info JSON bytes of key, evicting old entries over the size limit"""
+        blob = zlib.compress(info)
+        now = time.time()
+        try:
+            parsed = json.loads(info.decode(errors='replace'))
+        except ValueError:
+            parsed = {}
+        duration = self.estimate(parsed)
+        with self.lock:
+            if parsed.get('id') and duration:
+                self.connection.execute('INSERT OR REPLACE INTO durations (video_id, duration) VALUES (?, ?)',
+                                        (parsed['id'], duration))
+            self._delete(key)
+            self.connection.execute('INSERT INTO infos (key, info, size, fetched_at, used_at) VALUES (?, ?, ?, ?, ?)',
+                                    (key, blob, len(blob), now, now))
+            self.size += len(blob)
+            self._evict()
+            self.connection.commit()
+
+    def duration(self, video_id):
+        """Return the duration in seconds of a video seen before, or None"""
+        with self.lock:
+            row = self.connection.execute('SELECT duration FROM durations WHERE video_id = ?', (video_id,)).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def estimate(info, bytes_per_second=128 * 1024):
+        """Duration of a video from its info, guessed from the largest format size when missing"""
+        if info.get('duration'):
+            return float(info['duration'])
+        sizes = [fmt.get('filesize') or fmt.get('filesize_approx') or 0 for fmt in info.get('formats') or []]
+        size = max(sizes + [info.get('filesize') or info.get('filesize_approx') or 0])
+        return size / float(bytes_per_second) if size else None
+
+    def invalidate(self, key):
+        with self.lock:
+            self._delete(key)
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def _delete(self, key):
+        row = self.connection.execute('SELECT size FROM infos WHERE key = ?', (key,)).fetchone()
+        if row:
+            self.connection.execute('DELETE FROM infos WHERE key = ?', (key,))
+            self.size -= row[0]
+
+    def _evict(self):
+        """Drop the least recently used entries until the cache fits"""
+        while self.size > self.max_bytes:
+            rows = self.connection.execute('SELECT key, size FROM infos ORDER BY used_at LIMIT 100').fetchall()
+            if not rows:
+                self.size = 0
+                return
+            for key, size in rows:
+                self.connection.execute('DELETE FROM infos WHERE key = ?', (key,))
+                self.size -= size
+                if self.size <= self.max_bytes:
+                    return
@@ -0,0 +1,267 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+"""Job queue shared by several extractor nodes
+
+Nodes lease jobs for a while and keep their leases alive with heartbeats, jobs whose
+lease expires are delivered again to any node. Use a SQLite file on a shared filesystem,
+or run a coordinator and point nodes to tcp://host:port. The coordinator is meant for a
+trusted network, requests must carry the token it was started with:
+
+    YOUTUBE_EXTRACTOR_TOKEN=secret python3 jobqueue.py 0.0.0.0:7300 --db jobs.db
+"""
+from logger import *
+from abc import abstractmethod
+from argparse import ArgumentParser
+import os
+import hmac
+import json
+import time
+import socket
+import sqlite3
+import threading
+import contextlib
+
+# shared secret of a coordinator and its nodes
+TOKEN_VARIABLE = 'YOUTUBE_EXTRACTOR_TOKEN'
+
+def open_queue(address):
+    """Open a queue from a tcp://[token@]host:port coordinator address or a SQLite file path"""
+    if address.startswith('tcp://'):
+        token, _, address = address[len('tcp://'):].rpartition('@')
+        return RemoteQueue(address, token=token or os.environ.get(TOKEN_VARIABLE))
+    return SqliteQueue(address)
+
+class JobQueue(object):
+    """Jobs are urls, each in one of queued, leased, done or failed state"""
+    @abstractmethod
+    def put(self, urls):
+        """Queue urls, those already on the queue are left as they are"""
+        pass
+
+    @abstractmethod
+    def claim(self, node, count, lease):
+        """Lease up to count queued or expired jobs to node for lease seconds"""
+        pass
+
+    @abstractmethod
+    def heartbeat(self, node, urls, lease):
+        """Extend the leases node still holds"""
+        pass
+
+    @abstractmethod
+    def complete(self, node, url, succeeded, error=None):
+        """Record the outcome of a job and the node that handled it"""
+        pass
+
+    @abstractmethod
+    def pending(self):
+        """Number of jobs queued or leased"""
+        pass
+
+    @abstractmethod
+    def stats(self):
+        """List of node, state and job count of finished jobs"""
+        pass
+
+    def close(self):
+        pass
+
+class SqliteQueue(JobQueue):
+    """Queue in a SQLite file, claims are serialized by the database file lock"""
+    CHUNK = 1000
+
+    def __init__(self, path, timeout=60):
+        self.path = path if path == ':memory:' else os.path.expanduser(path)
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        # rollback journal, WAL needs shared memory that network filesystems lack
+        self.connection = sqlite3.connect(self.path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                                'url TEXT PRIMARY KEY, state TEXT NOT NULL DEFAULT \'queued\', '
+                                'node TEXT, lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0, '
+                                'error TEXT, submitted_at REAL, finished_at REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_until)')
+
+    def put(self, urls):
+        chunk = []
+        for url in urls:
+            chunk.append((url, time.time()))
+            if len(chunk) >= self.CHUNK:
+                self._insert(chunk)
+                chunk = []
+        if chunk:
+            self._insert(chunk)
+
+    def claim(self, node, count, lease):
+        now = time.time()
+        with self.lock, self._transaction():
+            urls = [row[0] for row in self.connection.execute(
+                'SELECT url FROM jobs WHERE state = \'queued\' OR (state = \'leased\' AND lease_until < ?) '
+                'ORDER BY rowid LIMIT ?', (now, count))]
+            self.connection.executemany('UPDATE jobs SET state = \'leased\', node = ?, lease_until = ?, '
+                                        'attempts = attempts + 1 WHERE url = ?',
+                                        [(node, now + lease, url) for url in urls])
+        return urls
+
+    def heartbeat(self, node, urls, lease):
+        with self.lock, self._transaction():
+            self.connection.executemany('UPDATE jobs SET lease_until = ? WHERE url = ? AND node = ? AND state = \'leased\'',
+                                        [(time.time() + lease, url, node) for url in urls])
+
+    def complete(self, node, url, succeeded, error=None):
+        with self.lock, self._transaction():
+            # a job delivered twice keeps the first success
+            self.connection.execute('UPDATE jobs SET state = ?, node = ?, error = ?, lease_until = NULL, finished_at = ? '
+                                    'WHERE url = ? AND state != \'done\'',
+                                    ('done' if succeeded else 'failed', node, error, time.time(), url))
+
+    def pending(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM jobs WHERE state IN (\'queued\', \'leased\')').fetchone()[0]
+
+    def stats(self):
+        with self.lock:
+            return [list(row) for row in self.connection.execute(
+                'SELECT node, state, COUNT(*) FROM jobs WHERE state IN (\'done\', \'failed\') GROUP BY node, state ORDER BY node')]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def _insert(self, rows):
+        with self.lock, self._transaction():
+            self.connection.executemany('INSERT OR IGNORE INTO jobs (url, submitted_at) VALUES (?, ?)', rows)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Write transaction taking the database lock up front"""
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+
+class RemoteQueue(JobQueue):
+    """Queue held by a coordinator, spoken to with one JSON line per call"""
+    METHODS = ('put', 'claim', 'heartbeat', 'complete', 'pending', 'stats')
+
+    def __init__(self, address, timeout=30, token=None):
+        host, _, port = address.rpartition(':')
+        self.address = (host or '127.0.0.1', int(port))
+        self.timeout = timeout
+        self.token = token
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def put(self, urls):
+        chunk = []
+        for url in urls:
+            chunk.append(url)
+            if len(chunk) >= SqliteQueue.CHUNK:
+                self._call('put', chunk)
+                chunk = []
+        if chunk:
+            self._call('put', chunk)
+
+    def claim(self, node, count, lease):
+        return self._call('claim', node, count, lease)
+
+    def heartbeat(self, node, urls, lease):
+        return self._call('heartbeat', node, list(urls), lease)
+
+    def complete(self, node, url, succeeded, error=None):
+        return self._call('complete', node, url, succeeded, error)
+
+    def pending(self):
+        return self._call('pending')
+
+    def stats(self):
+        return self._call('stats')
+
+    def close(self):
+        with self.lock:
+            if self.connection:
+                self.connection.close()
+                self.connection = None
+
+    def _call(self, method, *args):
+        """Send a call, reconnecting once when the coordinator dropped the connection"""
+        request = (json.dumps({'method': method, 'args': args, 'token': self.token}) + '\n').encode()
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if not self.connection:
+                        self.connection = socket.create_connection(self.address, self.timeout).makefile('rwb')
+                    self.connection.write(request)
+                    self.connection.flush()
+                    line = self.connection.readline()
+                    if not line:
+                        raise ConnectionError('Coordinator closed the connection')
+                    break
+                except OSError:
+                    if self.connection:
+                        self.connection.close()
+                    self.connection = None
+                    if attempt:
+                        raise
+        reply = json.loads(line.decode())
+        if 'error' in reply:
+            raise Exception('Coordinator error: ' + reply['error'])
+        return reply['result']
+
+class Coordinator(object):
+    """Serve a queue to remote nodes over TCP, only to those sending the token when there is one"""
+    def __init__(self, queue, address, token=None):
+        import socketserver
+        host, _, port = address.rpartition(':')
+        self.queue = queue
+        self.token = token
+        self.server = socketserver.ThreadingTCPServer((host or '127.0.0.1', int(port)), self._handler())
+        self.server.daemon_threads = True
+
+    def serve(self):
+        host = self.server.server_address[0]
+        if not self.token and not host.startswith('127.'):
+            logger.write('[-] Anyone reaching {} can queue and complete jobs, set {} or --token.'.format(host, TOKEN_VARIABLE), RED)
+        logger.log('[*] Coordinating jobs on {}:{}'.format(*self.server.server_address), YELLOW)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            self.queue.close()
+
+    def _handler(self):
+        import socketserver
+        queue = self.queue
+        token = self.token
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        request = json.loads(line.decode())
+                        if token and not hmac.compare_digest(str(request.get('token') or ''), token):
+                            self.wfile.write((json.dumps({'error': 'Invalid token'}) + '\n').encode())
+                            return
+                        if request['method'] not in RemoteQueue.METHODS:
+                            raise ValueError('Unknown method: ' + request['method'])
+                        reply = {'result': getattr(queue, request['method'])(*request['args'])}
+                    except Exception as e:
+                        reply = {'error': repr(e)}
+                    self.wfile.write((json.dumps(reply) + '\n').encode())
+        return Handler
+
+if __name__ == '__main__':
+    arguments = ArgumentParser(usage='usage: [options] address')
+    arguments.add_argument('--db', help='SQLite file holding the queue, :memory: to keep it in memory only.', dest='db', type=str, default='~/.youtube-extractor/jobs.db')
+    arguments.add_argument('--token', help='Token nodes must send, {} by default.'.format(TOKEN_VARIABLE), dest='token', type=str, default=os.environ.get(TOKEN_VARIABLE))
+    arguments.add_argument('address', help='host:port to listen on, a trusted network only')
+    opts = arguments.parse_args()
+    try:
+        Coordinator(SqliteQueue(opts.db), opts.address, opts.token).serve()
+    except KeyboardInterrupt:
+        logger.write('[*] Exiting.')
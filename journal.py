@@ -0,0 +1,113 @@
+import os
+import json
+import threading
+import collections
+
+class JournalLockedException(Exception):
+    pass
+
+class Journal(object):
+    """Append only log of job states, replayed on start to resume unfinished jobs"""
+    UNFINISHED = ('queued', 'running')
+
+    def __init__(self, path, interval=1.0):
+        self.path = os.path.expanduser(path)
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.handler = open(self.path, 'a+')
+        self._lock_file()
+        # latest state of every url not known to be done
+        self.states = collections.OrderedDict()
+        self._replay()
+        self._compact()
+        self.dirty = False
+        self.closed = threading.Event()
+        self.syncer = threading.Thread(target=self._sync_loop)
+        self.syncer.daemon = True
+        self.syncer.start()
+
+    def record(self, url, state):
+        """Append a state change, it reaches the disk on the next sync"""
+        line = json.dumps({'url': url, 'state': state}) + '\n'
+        with self.lock:
+            if self.handler.closed:
+                return
+            if state == 'done':
+                self.states.pop(url, None)
+            else:
+                self.states[url] = state
+            self.handler.write(line)
+            self.dirty = True
+
+    def state(self, url):
+        with self.lock:
+            return self.states.get(url)
+
+    def unfinished(self):
+        """Urls queued or running when the journal was last written, in submission order"""
+        with self.lock:
+            return [url for url, state in self.states.items() if state in self.UNFINISHED]
+
+    def sync(self):
+        """Flush and fsync every record written since the last sync"""
+        with self.lock:
+            if not self.dirty or self.handler.closed:
+                return
+            self.handler.flush()
+            self.dirty = False
+            descriptor = self.handler.fileno()
+            # fsync under the lock so close cannot release the descriptor meanwhile
+            os.fsync(descriptor)
+
+    def close(self):
+        self.closed.set()
+        self.sync()
+        with self.lock:
+            self.handler.close()
+
+    def _sync_loop(self):
+        """Group the records of every worker in one fsync per interval"""
+        while not self.closed.wait(self.interval):
+            self.sync()
+
+    def _lock_file(self):
+        """Keep other processes off the journal, nothing to do where flock is missing"""
+        try:
+            import fcntl
+        except ImportError:
+            return
+        try:
+            fcntl.flock(self.handler.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.handler.close()
+            raise JournalLockedException('Journal is used by another process: ' + self.path)
+
+    def _replay(self):
+        """Rebuild the latest state of each url, a torn last line is ignored"""
+        self.handler.seek(0)
+        for line in self.handler:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record['state'] == 'done':
+                self.states.pop(record['url'], None)
+            else:
+                self.states[record['url']] = record['state']
+
+    def _compact(self):
+        """Rewrite the journal with one line per url, done urls are on the index already"""
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as handler:
+            for url, state in self.states.items():
+                handler.write(json.dumps({'url': url, 'state': state}) + '\n')
+            handler.flush()
+            os.fsync(handler.fileno())
+        os.replace(temporary, self.path)
+        # the lock belongs to the replaced file, take it on the new one
+        self.handler.close()
+        self.handler = open(self.path, 'a')
+        self._lock_file()
@@ -1,18 +1,140 @@
+import sys
+import time
+import queue
+import atexit
+import shutil
+import threading
+
 # Terminal colors
 NULL   = '\033[0m' # -> Reset
-BLUE   = '\033[34m' 
-YELLOW = '\033[33m' 
-GREEN  = '\033[32m' 
+BLUE   = '\033[34m'
+YELLOW = '\033[33m'
+GREEN  = '\033[32m'
 RED    = '\033[031m'
 
+class Renderer(object):
+    """Only writer of the console, every thread hands it lines and progress without waiting on stdout"""
+    def __init__(self, interval=0.1, buffered_interval=1.0, summary_interval=10.0, rows=10):
+        self.interval = interval
+        self.buffered_interval = buffered_interval
+        self.summary_interval = summary_interval
+        self.rows = rows
+        self.summaries = False
+        self.lines = queue.SimpleQueue()
+        # plain dict writes are atomic, workers never take a lock to report progress
+        self.active = {}
+        self.drawn = 0
+        self.summarized_at = time.time()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def write(self, line):
+        """Queue a line, it is written on the next redraw"""
+        self.lines.put(line)
+        if not self.thread:
+            self._start()
+
+    def progress(self, key, value):
+        """Show value, redrawn with str(), in the status of running jobs"""
+        self.active[key] = value
+        if not self.thread:
+            self._start()
+
+    def finish(self, key):
+        self.active.pop(key, None)
+
+    def flush(self):
+        """Write every queued line and clear the status"""
+        self._draw(final=True)
+
+    def _start(self):
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        """Redraw at a fixed rate, flush lines less often when not writing to a terminal"""
+        while True:
+            time.sleep(self.interval if self._tty() else self.buffered_interval)
+            self._draw()
+
+    def _draw(self, final=False):
+        with self.lock:
+            stream = sys.stdout
+            tty = self._tty()
+            output = []
+            if self.drawn:
+                # move to the first status line and clear down to the end of the screen
+                output.append('\033[{}F\033[J'.format(self.drawn))
+                self.drawn = 0
+            while True:
+                try:
+                    output.append(self.lines.get_nowait() + '\n')
+                except queue.Empty:
+                    break
+            active = list(self.active.copy().values())
+            if tty and not final and active:
+                status = self._status(active)
+                output.extend(row + '\n' for row in status)
+                self.drawn = len(status)
+            elif not tty and self.summaries and active and time.time() - self.summarized_at > self.summary_interval:
+                output.append(self._summary(active) + '\n')
+                self.summarized_at = time.time()
+            if output:
+                try:
+                    stream.write(''.join(output))
+                    stream.flush()
+                except (OSError, ValueError):
+                    pass
+
+    def _status(self, active):
+        """Summary line and one line per job, cut to the terminal width so nothing wraps"""
+        width = shutil.get_terminal_size().columns - 1
+        rows = [self._summary(active)]
+        rows.extend(str(value)[:width] + NULL for value in active[:self.rows])
+        if len(active) > self.rows:
+            rows.append('    ... and {} more'.format(len(active) - self.rows))
+        return rows
+
+    def _summary(self, active):
+        speed = sum(getattr(value, 'speed', None) or 0 for value in active)
+        return '[*] {} running at {:.2f} MiB/s'.format(len(active), speed / 1048576.0)
+
+    def _tty(self):
+        try:
+            return sys.stdout.isatty()
+        except (AttributeError, ValueError):
+            return False
+
 class Logger(object):
     """Print verbosity layer"""
     def __init__(self):
         self.__verbose = False
+        self.renderer = Renderer()
 
     def log(self, message, color=NULL):
         if self.__verbose:
-            print(color + message + NULL)
-    
+            self.renderer.write(color + message + NULL)
+
+    def write(self, message, color=NULL):
+        """Print a message whatever the verbosity"""
+        self.renderer.write(color + message + NULL)
+
+    def progress(self, key, value):
+        self.renderer.progress(key, value)
+
+    def finish(self, key):
+        self.renderer.finish(key)
+
+    def flush(self):
+        self.renderer.flush()
+
     def set_verbose(self):
         self.__verbose = True
+        self.renderer.summaries = True
+
+logger = Logger()
+atexit.register(logger.flush)
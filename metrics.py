@@ -0,0 +1,136 @@
+from logger import *
+import os
+import json
+import time
+import bisect
+import threading
+import contextlib
+
+class Histogram(object):
+    """Cumulative histogram in the prometheus layout"""
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Instrumentation(object):
+    """Phase timings written as JSON lines and exported as prometheus metrics"""
+    PREFIX = 'youtube_extractor_'
+
+    def __init__(self):
+        self.trace = None
+        self.server = None
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def configure(self, trace=None, port=None):
+        """Open the trace file and start the metrics endpoint on localhost"""
+        if trace:
+            self.trace = open(os.path.expanduser(trace), 'a')
+        if port:
+            from http.server import ThreadingHTTPServer
+            self.server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+            self.server.daemon_threads = True
+            thread = threading.Thread(target=self.server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            logger.log('[*] Serving metrics on http://127.0.0.1:{}/metrics'.format(self.server.server_port), YELLOW)
+
+    def close(self):
+        """Flush the trace file and stop the metrics endpoint"""
+        with self.lock:
+            if self.trace:
+                self.trace.close()
+                self.trace = None
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    @contextlib.contextmanager
+    def phase(self, name, **labels):
+        """Time the wrapped block as a phase"""
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - started, **labels)
+
+    def record(self, name, seconds, **labels):
+        """Record a phase that took seconds"""
+        self.observe('phase_seconds', seconds, phase=name)
+        self.event(name, seconds=round(seconds, 6), **labels)
+
+    def event(self, name, **fields):
+        """Append an event to the trace file"""
+        if not self.trace:
+            return
+        fields.update(ts=round(time.time(), 6), event=name)
+        line = json.dumps(fields) + '\n'
+        with self.lock:
+            if self.trace:
+                self.trace.write(line)
+
+    def inc(self, name, value=1, **labels):
+        """Increase a counter"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Add a value to a histogram"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def render(self):
+        """Return every metric in the prometheus text format"""
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append('{}{}{} {}'.format(self.PREFIX, name, self._labels(labels), value))
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(Histogram.BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append('{}{}_bucket{} {}'.format(self.PREFIX, name, self._labels(labels + (('le', bound),)), cumulative))
+                lines.append('{}{}_sum{} {}'.format(self.PREFIX, name, self._labels(labels), histogram.sum))
+                lines.append('{}{}_count{} {}'.format(self.PREFIX, name, self._labels(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def _labels(self, labels):
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(key, value) for key, value in labels) + '}'
+
+    def _handler(self):
+        from http.server import BaseHTTPRequestHandler
+        instrumentation = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = instrumentation.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+        return Handler
+
+metrics = Instrumentation()
@@ -0,0 +1,311 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+"""Download a file over several connections at once, each fetching byte ranges
+
+Takes the arguments youtube-dl hands to axel, so it runs as youtube-dl's external
+downloader through the axel shim in the downloader folder:
+
+    segmented.py [-n CONNECTIONS] [-s BYTES_PER_SECOND] [--proxy URL[,URL]] [-k] -o FILE [-H HEADER]... -- URL
+
+Like axel, the ranges written are kept in FILE.st so an interrupted download resumes.
+"""
+import os
+import sys
+import ssl
+import json
+import time
+import queue
+import threading
+import http.client
+from urllib.parse import urlsplit, urljoin
+from argparse import ArgumentParser
+
+class RangeNotSupportedException(Exception):
+    pass
+
+class SegmentedDownloader(object):
+    """Fetch pieces of a file concurrently over pooled connections and write them in place"""
+    CHUNK = 65536
+    MIN_PIECE = 1024 * 1024
+    RETRIES = 3
+
+    def __init__(self, url, path, connections=8, headers=None, proxies=None, rate=None, insecure=False, timeout=30):
+        self.url = url
+        self.path = path
+        self.connections = max(1, connections)
+        self.headers = headers if headers else {}
+        self.proxies = proxies if proxies else []
+        self.rate = rate
+        self.timeout = timeout
+        self.context = ssl._create_unverified_context() if insecure else ssl.create_default_context()
+        self.state = path + '.st'
+        self.size = None
+        self.downloaded = 0
+        # bytes already on disk from an interrupted download
+        self.resumed = 0
+        self.done = []
+        # first offset and offset reached of the piece each worker is writing
+        self.writing = {}
+        self.started = None
+        self.lock = threading.Lock()
+        self.errors = []
+
+    def download(self, progress=None):
+        """Download the whole file, calling progress with the downloader every half second"""
+        self.started = time.time()
+        connection, response = self._probe()
+        if response.status != 206:
+            # no ranges, the probe response is the whole file
+            self._write_stream(response)
+            connection.close()
+            return self.downloaded
+        response.read()
+        self.done = self._load_state()
+        pieces = queue.Queue()
+        size = max(self.MIN_PIECE, self.size // (self.connections * 4) + 1)
+        missing = list(self._missing(self.done))
+        for first, last in missing:
+            for start in range(first, last + 1, size):
+                pieces.put((start, min(start + size - 1, last)))
+        self.resumed = self.size - sum(last - first + 1 for first, last in missing)
+        if pieces.empty():
+            connection.close()
+        if self.done:
+            descriptor = os.open(self.path, os.O_RDWR)
+        else:
+            descriptor = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            if not self.done:
+                self._preallocate(descriptor)
+            workers = []
+            for index in range(min(self.connections, pieces.qsize())):
+                worker = threading.Thread(target=self._work, args=(index, pieces, descriptor, connection if index == 0 else None))
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+            alive = workers
+            while alive:
+                alive[0].join(0.5)
+                alive = [worker for worker in alive if worker.is_alive()]
+                self._save_state()
+                if progress:
+                    progress(self)
+        finally:
+            os.close(descriptor)
+        if self.errors:
+            raise self.errors[0]
+        try:
+            os.remove(self.state)
+        except OSError:
+            pass
+        return self.downloaded
+
+    @property
+    def speed(self):
+        elapsed = time.time() - self.started
+        return self.downloaded / elapsed if elapsed > 0 else 0.0
+
+    def _probe(self):
+        """Follow redirects and ask for the first byte to learn the size and whether ranges work"""
+        for _ in range(5):
+            connection = self._connect(self._proxy(0))
+            connection.request('GET', self._target(), headers=dict(self.headers, Range='bytes=0-0'))
+            response = connection.getresponse()
+            if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+                response.read()
+                connection.close()
+                self.url = urljoin(self.url, response.getheader('Location'))
+                continue
+            if response.status == 206:
+                total = (response.getheader('Content-Range') or '').rpartition('/')[2]
+                if not total.isdigit():
+                    raise RangeNotSupportedException('Unknown size of ' + self.url)
+                self.size = int(total)
+            elif response.status == 200:
+                length = response.getheader('Content-Length')
+                self.size = int(length) if length and length.isdigit() else None
+            else:
+                raise http.client.HTTPException('HTTP Error {}: {}'.format(response.status, response.reason))
+            return connection, response
+        raise http.client.HTTPException('Too many redirects: ' + self.url)
+
+    def _work(self, index, pieces, descriptor, connection):
+        """Fetch pieces until none is left, reusing one connection"""
+        proxy = self._proxy(index)
+        while not self.errors:
+            try:
+                start, end = pieces.get_nowait()
+            except queue.Empty:
+                break
+            piece = self.writing[index] = [start, start]
+            attempt = 0
+            while piece[1] <= end:
+                try:
+                    if not connection:
+                        connection = self._connect(proxy)
+                    self._fetch(connection, piece, end, descriptor)
+                except (OSError, http.client.HTTPException) as e:
+                    if connection:
+                        connection.close()
+                    connection = None
+                    attempt += 1
+                    if attempt > self.RETRIES:
+                        self.errors.append(e)
+                        return
+                    time.sleep(attempt)
+            with self.lock:
+                self.done.append((start, end))
+                del self.writing[index]
+        if connection:
+            connection.close()
+
+    def _fetch(self, connection, piece, end, descriptor):
+        """Write a byte range at its offset, from the offset the piece reached"""
+        start = piece[1]
+        connection.request('GET', self._target(), headers=dict(self.headers, Range='bytes={}-{}'.format(start, end)))
+        response = connection.getresponse()
+        if response.status != 206:
+            response.read()
+            raise http.client.HTTPException('HTTP Error {} on range {}-{}'.format(response.status, start, end))
+        while start <= end:
+            data = response.read(min(self.CHUNK, end - start + 1))
+            if not data:
+                raise http.client.IncompleteRead(b'', end - start + 1)
+            self._pwrite(descriptor, data, start)
+            start += len(data)
+            piece[1] = start
+            self._account(len(data))
+
+    def _write_stream(self, response):
+        """Plain download when the server ignores ranges"""
+        with open(self.path, 'wb') as handler:
+            while True:
+                data = response.read(self.CHUNK)
+                if not data:
+                    break
+                handler.write(data)
+                self._account(len(data))
+
+    def _account(self, length):
+        """Count downloaded bytes and sleep while over the rate"""
+        with self.lock:
+            self.downloaded += length
+            downloaded = self.downloaded
+        if self.rate:
+            delay = downloaded / float(self.rate) - (time.time() - self.started)
+            if delay > 0:
+                time.sleep(delay)
+
+    def _load_state(self):
+        """Return the ranges written by an interrupted download of a file of the same size"""
+        try:
+            with open(self.state) as handler:
+                state = json.load(handler)
+            if state['size'] == self.size and os.path.getsize(self.path) == self.size:
+                return sorted((start, end) for start, end in state['ranges'])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return []
+
+    def _save_state(self):
+        """Record the ranges written, a piece being written counts up to the offset it reached"""
+        with self.lock:
+            ranges = self.done + [(first, reached - 1) for first, reached in self.writing.values() if reached > first]
+        try:
+            with open(self.state + '.tmp', 'w') as handler:
+                json.dump({'size': self.size, 'ranges': ranges}, handler)
+            os.replace(self.state + '.tmp', self.state)
+        except OSError:
+            pass
+
+    def _missing(self, ranges):
+        """Yield the ranges of the file not in the sorted ranges given"""
+        offset = 0
+        for start, end in ranges:
+            if start > offset:
+                yield offset, start - 1
+            offset = max(offset, end + 1)
+        if offset < self.size:
+            yield offset, self.size - 1
+
+    def _preallocate(self, descriptor):
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(descriptor, 0, self.size)
+                return
+            except OSError:
+                pass
+        os.ftruncate(descriptor, self.size)
+
+    def _pwrite(self, descriptor, data, offset):
+        if hasattr(os, 'pwrite'):
+            os.pwrite(descriptor, data, offset)
+            return
+        with self.lock:
+            os.lseek(descriptor, offset, os.SEEK_SET)
+            os.write(descriptor, data)
+
+    def _proxy(self, index):
+        return self.proxies[index % len(self.proxies)] if self.proxies else None
+
+    def _target(self):
+        parts = urlsplit(self.url)
+        return (parts.path or '/') + ('?' + parts.query if parts.query else '')
+
+    def _connect(self, proxy):
+        """Open a connection to the file host, through a socks proxy when given"""
+        parts = urlsplit(self.url)
+        if parts.scheme == 'https':
+            connection = http.client.HTTPSConnection(parts.hostname, parts.port or 443, timeout=self.timeout, context=self.context)
+        else:
+            connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=self.timeout)
+        if proxy:
+            import socks
+            proxy = urlsplit(proxy)
+            sock = socks.create_connection((connection.host, connection.port), self.timeout, proxy_type=socks.SOCKS5,
+                                           proxy_addr=proxy.hostname, proxy_port=proxy.port, proxy_rdns=True)
+            if parts.scheme == 'https':
+                sock = self.context.wrap_socket(sock, server_hostname=connection.host)
+            connection.sock = sock
+        return connection
+
+def report(downloader):
+    """Print progress the way youtube-dl does, so the extractor can parse it"""
+    if not downloader.size:
+        return
+    speed = downloader.speed
+    written = downloader.resumed + downloader.downloaded
+    eta = int((downloader.size - written) / speed) if speed else 0
+    print('[download] {:5.1f}% of {:.2f}MiB at {:.2f}MiB/s ETA {:02d}:{:02d}'.format(
+        100.0 * written / downloader.size, downloader.size / 1048576.0, speed / 1048576.0,
+        eta // 60, eta % 60), flush=True)
+
+def main(args):
+    arguments = ArgumentParser(usage='usage: [options] -o FILE -- url')
+    arguments.add_argument('-V', '--version', help='Print version and exit.', dest='version', action='store_true', default=False)
+    arguments.add_argument('-o', help='Output file.', dest='output', type=str)
+    arguments.add_argument('-H', help='Header to send, repeatable.', dest='headers', action='append')
+    arguments.add_argument('-n', help='Number of connections.', dest='connections', type=int, default=8)
+    arguments.add_argument('-s', help='Maximum speed in bytes per second.', dest='rate', type=int)
+    arguments.add_argument('-k', help='Do not verify certificates.', dest='insecure', action='store_true', default=False)
+    arguments.add_argument('--proxy', help='Comma separated socks proxies, connections are spread across them.', dest='proxy', type=str)
+    arguments.add_argument('url', nargs='?')
+    opts = arguments.parse_args(args)
+    if opts.version:
+        print('segmented 1.0')
+        return 0
+    if not opts.output or not opts.url:
+        arguments.error('an output file and an url are required')
+    headers = dict(header.split(': ', 1) for header in opts.headers or [] if ': ' in header)
+    downloader = SegmentedDownloader(opts.url, opts.output, opts.connections, headers,
+                                     opts.proxy.split(',') if opts.proxy else None, opts.rate, opts.insecure)
+    try:
+        downloader.download(report)
+    except (OSError, http.client.HTTPException, RangeNotSupportedException) as e:
+        sys.stderr.write('ERROR: {}\n'.format(e))
+        return 1
+    report(downloader)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
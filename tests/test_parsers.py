@@ -0,0 +1,168 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+"""Table driven checks of the youtube-dl output and url parsers
+
+    python3 -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extractor import Progress, BatchProgress, RetryPolicy, UrlReader
+
+class ProgressTest(unittest.TestCase):
+    LINES = [
+        # line, carried progress, percent, total bytes, speed, eta
+        ('[download]  50.0% of 10.00MiB at  1.00MiB/s ETA 00:05', True, 50.0, 10485760, 1048576, 5),
+        ('[download] 100% of 1.5GiB in 01:02', True, 100.0, 1610612736, None, None),
+        ('[download]   3.2% of ~20.00MiB at 512.00KiB/s ETA 01:02:03', True, 3.2, 20971520, 524288, 3723),
+        ('[download]  12.0% of 100.00MB at  2.00MB/s ETA 00:44', True, 12.0, 100000000, 2000000, 44),
+        ('[download] Destination: video.webm', False, 0.0, None, None, None),
+        ('[youtube] abcdefghijk: Downloading webpage', False, 0.0, None, None, None),
+        ('', False, 0.0, None, None, None),
+    ]
+
+    def test_progress_lines(self):
+        for line, carried, percent, total, speed, eta in self.LINES:
+            with self.subTest(line=line):
+                progress = Progress('https://www.youtube.com/watch?v=abcdefghijk')
+                self.assertEqual(progress.update(line), carried)
+                self.assertEqual(progress.percent, percent)
+                self.assertEqual(progress.total_bytes, total)
+                self.assertEqual(progress.speed, speed)
+                self.assertEqual(progress.eta, eta)
+
+    def test_filenames(self):
+        lines = [
+            ('[download] Destination: a b.webm', 'a b.webm', None),
+            ('[download] a b.webm has already been downloaded', 'a b.webm', None),
+            ('[info] Writing video description metadata as JSON to: a.info.json', None, 'a.info.json'),
+            ('[info] Writing video metadata as JSON to: a.info.json', None, 'a.info.json'),
+        ]
+        for line, filename, info_filename in lines:
+            with self.subTest(line=line):
+                progress = Progress()
+                progress.update(line)
+                self.assertEqual(progress.filename, filename)
+                self.assertEqual(progress.info_filename, info_filename)
+
+    def test_errors(self):
+        progress = Progress()
+        for line in ('[youtube] abcdefghijk: Downloading webpage', 'ERROR: Video unavailable', 'WARNING: retrying'):
+            progress.update(line)
+        progress.returncode = 1
+        self.assertFalse(progress.succeeded)
+        self.assertEqual(progress.error(), 'ERROR: Video unavailable')
+
+class BatchProgressTest(unittest.TestCase):
+    OUTCOMES = [
+        # outcome of each video as ok, error or missing, exit code, expected results
+        (['ok', 'ok', 'ok'], 0, [True, True, True]),
+        (['ok', 'error', 'ok'], 1, [True, False, True]),
+        (['ok', 'ok', 'error'], 1, [True, True, False]),
+        (['error', 'error', 'ok'], 1, [False, False, True]),
+        # no video said why, the one running when youtube-dl exited failed
+        (['ok', 'ok', 'ok'], 1, [True, True, False]),
+        (['ok', 'error', 'ok'], -15, [True, False, False]),
+        (['ok', 'ok', 'missing'], 1, [True, False, False]),
+        (['ok', 'missing', 'missing'], 0, [True, False, False]),
+    ]
+
+    def test_results(self):
+        for outcomes, returncode, expected in self.OUTCOMES:
+            with self.subTest(outcomes=outcomes, returncode=returncode):
+                video_ids = ['video{:06d}'.format(i) for i in range(len(outcomes))]
+                progress = BatchProgress(['https://www.youtube.com/watch?v=' + video_id for video_id in video_ids])
+                for video_id, outcome in zip(video_ids, outcomes):
+                    if outcome == 'missing':
+                        continue
+                    progress.update('[youtube] {}: Downloading webpage'.format(video_id))
+                    if outcome == 'error':
+                        progress.update('ERROR: Video unavailable')
+                    else:
+                        progress.update('[download] 100.0% of 1.00MiB at 1.00MiB/s ETA 00:00')
+                progress.returncode = returncode
+                self.assertEqual([succeeded for job, succeeded in progress.results()], expected)
+                self.assertEqual(progress.succeeded, all(expected))
+
+class RetryPolicyTest(unittest.TestCase):
+    OUTCOMES = [
+        # error line, exit code, kind
+        ('ERROR: unable to download video data: HTTP Error 429: Too Many Requests', 1, 'throttled'),
+        ('ERROR: Video unavailable', 1, 'permanent'),
+        ('ERROR: This video is private', 1, 'permanent'),
+        ('ERROR: unable to download webpage: HTTP Error 404: Not Found', 1, 'permanent'),
+        ('ERROR: Unsupported URL: https://example.com', 1, 'permanent'),
+        ('youtube-dl: error: no such option: --bogus', 2, 'permanent'),
+        ('ERROR: unable to download video data: <urlopen error timed out>', 1, 'transient'),
+        ('ERROR: unable to download webpage: HTTP Error 503: Service Unavailable', 1, 'transient'),
+        ('', 1, 'transient'),
+    ]
+
+    def test_classify(self):
+        policy = RetryPolicy()
+        for line, returncode, kind in self.OUTCOMES:
+            with self.subTest(line=line):
+                progress = Progress()
+                progress.update(line)
+                progress.returncode = returncode
+                self.assertEqual(policy.classify(progress), kind)
+
+    def test_delay(self):
+        policy = RetryPolicy(base=2.0, cap=10.0)
+        for attempt, bound in ((1, 4.0), (2, 8.0), (5, 10.0)):
+            with self.subTest(attempt=attempt):
+                self.assertTrue(0 <= policy.delay(attempt) <= bound)
+
+class UrlReaderTest(unittest.TestCase):
+    IDS = [
+        ('https://www.youtube.com/watch?v=abcdefghijk', 'abcdefghijk'),
+        ('http://youtube.com/watch?feature=share&v=abc-efg_ijk', 'abc-efg_ijk'),
+        ('https://m.youtube.com/watch?v=abcdefghijk&t=10', 'abcdefghijk'),
+        ('youtu.be/abcdefghijk', 'abcdefghijk'),
+        ('https://www.youtube.com/embed/abcdefghijk', 'abcdefghijk'),
+        ('https://www.youtube.com/shorts/abcdefghijk', 'abcdefghijk'),
+        ('https://www.youtube.com/watch?v=short', None),
+        ('https://example.com/watch?v=abcdefghijk', None),
+        ('https://www.youtube.com/playlist?list=PLabc', None),
+    ]
+    PLAYLISTS = [
+        ('https://www.youtube.com/playlist?list=PLabc_123', True),
+        ('https://www.youtube.com/channel/UCabc', True),
+        ('https://www.youtube.com/c/name', True),
+        ('https://www.youtube.com/user/name', True),
+        ('https://www.youtube.com/@name', True),
+        ('https://www.youtube.com/watch?v=abcdefghijk', False),
+        ('https://example.com/playlist?list=PLabc', False),
+    ]
+
+    def test_video_id(self):
+        for url, video_id in self.IDS:
+            with self.subTest(url=url):
+                self.assertEqual(UrlReader.video_id(url), video_id)
+
+    def test_is_playlist(self):
+        for url, playlist in self.PLAYLISTS:
+            with self.subTest(url=url):
+                self.assertEqual(UrlReader.is_playlist(url), playlist)
+
+    def test_entries_are_canonical_and_unique(self):
+        reader = UrlReader(['youtu.be/abcdefghijk', 'https://www.youtube.com/watch?v=bbcdefghijk',
+                            'https://m.youtube.com/watch?v=abcdefghijk', 'not an url'])
+        self.assertEqual(list(reader), ['https://www.youtube.com/watch?v=abcdefghijk',
+                                        'https://www.youtube.com/watch?v=bbcdefghijk'])
+
+    def test_file(self):
+        import tempfile
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as handler:
+            handler.write('\nyoutu.be/abcdefghijk\n\n  https://www.youtube.com/watch?v=bbcdefghijk  \n')
+        try:
+            self.assertEqual(list(UrlReader(path=handler.name)), ['https://www.youtube.com/watch?v=abcdefghijk',
+                                                                 'https://www.youtube.com/watch?v=bbcdefghijk'])
+        finally:
+            os.remove(handler.name)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,309 @@
+from logger import *
+from metrics import metrics
+import os
+import re
+import json
+import time
+import socket
+import threading
+
+class Circuit(object):
+    """A tor SocksPort with its own health and throughput accounting"""
+    def __init__(self, socks_port, control_port=None, process=None, identity=None):
+        self.socks_port = socks_port
+        self.control_port = control_port
+        self.process = process
+        self.identity = identity
+        self.active = 0
+        self.jobs = 0
+        self.failures = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.speed = None
+        self.renewed_at = 0.0
+        # lock file held while this run owns the ports and data directory
+        self.claim = None
+
+    @property
+    def proxy(self):
+        """Proxy url to hand to youtube-dl"""
+        return 'socks5://127.0.0.1:{}'.format(self.socks_port)
+
+    def record(self, downloaded_bytes, seconds, succeeded, smoothing=0.3):
+        """Account a finished job on this circuit"""
+        self.jobs += 1
+        self.failures = 0 if succeeded else self.failures + 1
+        if downloaded_bytes and seconds > 0:
+            self.bytes += downloaded_bytes
+            self.seconds += seconds
+            speed = downloaded_bytes / seconds
+            self.speed = speed if self.speed is None else smoothing * speed + (1 - smoothing) * self.speed
+
+    def renew(self):
+        """Ask tor for a new identity on this circuit"""
+        if not self.control_port:
+            return False
+        import stem
+        import stem.control
+        import stem.connection
+        try:
+            with stem.control.Controller.from_port(port=self.control_port) as controller:
+                controller.authenticate()
+                controller.signal(stem.Signal.NEWNYM)
+        except (stem.SocketError, stem.connection.AuthenticationFailure) as e:
+            logger.log('[-] Could not renew circuit on port {}: {}'.format(self.socks_port, e), RED)
+            return False
+        if self.identity:
+            self.identity.invalidate(self.socks_port)
+        logger.log('[*] Renewed circuit on port {}.'.format(self.socks_port), YELLOW)
+        self.renewed_at = time.time()
+        self.failures = 0
+        self.speed = None
+        return True
+
+    def __repr__(self):
+        return 'Circuit({}, jobs={}, active={}, speed={})'.format(self.socks_port, self.jobs, self.active, self.speed)
+
+class TorPool(object):
+    """Spread downloads across several tor SocksPorts, launched or attached"""
+    # tor refuses NEWNYM signals sent more often than this
+    RENEW_INTERVAL = 10
+    MAX_FAILURES = 3
+    # port pairs probed past the ones asked for, when other runs or programs hold them
+    SPARE_PORTS = 50
+
+    def __init__(self, circuits, slow_ratio=0.5, min_jobs=3, identity=None):
+        self.circuits = circuits
+        for circuit in circuits:
+            circuit.identity = identity
+        self.slow_ratio = slow_ratio
+        self.min_jobs = min_jobs
+        self.lock = threading.Lock()
+
+    @classmethod
+    def launch(cls, count, base_port=9060, directory='~/.youtube-extractor/tor', **kwargs):
+        """Launch count tor instances at once, each one with its own socks and control port
+
+        Every port keeps its data directory across runs, so tor bootstraps from its cached consensus.
+        Ports held by a concurrent run or another program are skipped.
+        """
+        import stem.process
+        directory = os.path.expanduser(directory)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        circuits = []
+        for socks_port in range(base_port, base_port + (count + cls.SPARE_PORTS) * 2, 2):
+            if len(circuits) == count:
+                break
+            circuit = cls._claim(directory, socks_port)
+            if circuit:
+                circuits.append(circuit)
+        if len(circuits) < count:
+            logger.write('[-] Only {} free tor port pairs from port {}.'.format(len(circuits), base_port), RED)
+
+        def bootstrap(circuit):
+            logger.log('[*] Launching tor on port {}.'.format(circuit.socks_port), YELLOW)
+            data_directory = os.path.join(directory, str(circuit.socks_port))
+            try:
+                if not os.path.isdir(data_directory):
+                    # tor refuses data directories readable by others
+                    os.makedirs(data_directory, 0o700)
+                circuit.process = stem.process.launch_tor_with_config(config={
+                    'SocksPort': str(circuit.socks_port),
+                    'ControlPort': str(circuit.control_port),
+                    'CookieAuthentication': '1',
+                    'DataDirectory': data_directory,
+                }, take_ownership=True)
+            except OSError as e:
+                logger.log('[-] Failed to start tor on port {}: {}'.format(circuit.socks_port, e), RED)
+
+        threads = [threading.Thread(target=bootstrap, args=(circuit,)) for circuit in circuits]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for circuit in circuits:
+            if not circuit.process:
+                circuit.claim.close()
+        circuits = [circuit for circuit in circuits if circuit.process]
+        if not circuits:
+            raise Exception('Could not launch any tor instance.')
+        pool = cls(circuits, **kwargs)
+        # a new tor process on a port used by an earlier run has another exit IP
+        pool.forget_identities()
+        return pool
+
+    @staticmethod
+    def _claim(directory, socks_port):
+        """Take a socks and control port pair for this run, None when it is in use"""
+        handler = open(os.path.join(directory, '{}.lock'.format(socks_port)), 'a')
+        try:
+            import fcntl
+            fcntl.flock(handler.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except ImportError:
+            pass
+        except OSError:
+            # another run launched tor on these ports, with this data directory
+            handler.close()
+            return None
+        for port in (socks_port, socks_port + 1):
+            probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                probe.bind(('127.0.0.1', port))
+            except OSError:
+                handler.close()
+                return None
+            finally:
+                probe.close()
+        circuit = Circuit(socks_port, socks_port + 1)
+        circuit.claim = handler
+        return circuit
+
+    @classmethod
+    def attach(cls, ports, **kwargs):
+        """Use already running SocksPorts, given as socks[:control] strings"""
+        circuits = []
+        for port in ports:
+            socks_port, _, control_port = str(port).partition(':')
+            circuits.append(Circuit(int(socks_port), int(control_port) if control_port else None))
+        return cls(circuits, **kwargs)
+
+    def acquire(self, preferred=None):
+        """Pick the preferred circuit while it is healthy, the least busy healthy one otherwise"""
+        with self.lock:
+            if preferred in self.circuits and preferred.failures < self.MAX_FAILURES:
+                circuit = preferred
+            else:
+                circuit = min(self.circuits, key=lambda c: (c.failures >= self.MAX_FAILURES, c.active, c.jobs))
+            circuit.active += 1
+            return circuit
+
+    def release(self, circuit, downloaded_bytes, seconds, succeeded):
+        """Account a finished job and rotate the circuit when it is failing or slow"""
+        with self.lock:
+            circuit.active -= 1
+            circuit.record(downloaded_bytes, seconds, succeeded)
+            renew = self._should_renew(circuit)
+            if renew:
+                circuit.renewed_at = time.time()
+        if renew:
+            circuit.renew()
+
+    def stop(self):
+        """Terminate the tor instances launched by the pool"""
+        launched = [circuit for circuit in self.circuits if circuit.process]
+        for circuit in launched:
+            circuit.process.kill()
+            circuit.process.wait()
+            circuit.process = None
+            circuit.claim.close()
+        self.forget_identities(launched)
+
+    def forget_identities(self, circuits=None):
+        """Drop the cached exit IPs of circuits, all of them by default"""
+        for circuit in self.circuits if circuits is None else circuits:
+            if circuit.identity:
+                circuit.identity.invalidate(circuit.socks_port)
+
+    def stats(self):
+        """Return a snapshot of every circuit"""
+        with self.lock:
+            return [(c.socks_port, c.jobs, c.failures, c.bytes, c.speed) for c in self.circuits]
+
+    def _should_renew(self, circuit):
+        """Indicate wheter a circuit keeps failing or is much slower than the others"""
+        if not circuit.control_port or time.time() - circuit.renewed_at < self.RENEW_INTERVAL:
+            return False
+        if circuit.failures >= self.MAX_FAILURES:
+            return True
+        speeds = sorted(c.speed for c in self.circuits if c.speed is not None)
+        if circuit.speed is None or circuit.jobs < self.min_jobs or len(speeds) < 2:
+            return False
+        median = speeds[len(speeds) // 2]
+        return circuit.speed < median * self.slow_ratio
+
+class IdentityCheck(object):
+    """Find out the exit IP of tor circuits, caching each one for a while"""
+    TOR_PATTERN = re.compile(r'Your IP address appears to be:\s*<strong>(\d{1,3}(?:\.\d{1,3}){3})')
+    IP_PATTERN = re.compile(r'\b(\d{1,3}(?:\.\d{1,3}){3})\b')
+
+    def __init__(self, url='https://check.torproject.org', ttl=600, path=None, timeout=30):
+        self.url = url
+        self.ttl = ttl
+        self.path = os.path.expanduser(path) if path else None
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.cache = self._load()
+
+    def cached(self, port):
+        """Return the cached IP of a circuit when it is still fresh"""
+        with self.lock:
+            entry = self.cache.get(str(port))
+        if entry and time.time() - entry[1] < self.ttl:
+            return entry[0]
+        return None
+
+    def lookup(self, port):
+        """Return the exit IP of the circuit behind a SocksPort, fetching it when not cached"""
+        ip = self.cached(port)
+        if ip:
+            return ip
+        import urllib.request
+        import socks
+        import sockshandler
+        opener = urllib.request.build_opener(sockshandler.SocksiPyHandler(socks.SOCKS5, '127.0.0.1', port))
+        with metrics.phase('tor_identity', port=port):
+            response = opener.open(self.url, timeout=self.timeout).read().decode(errors='replace')
+        if 'Sorry. You are not using Tor' in response:
+            raise Exception('Could not bind tor proxy on socket.')
+        match = self.TOR_PATTERN.search(response) or self.IP_PATTERN.search(response)
+        if not match:
+            raise Exception('Unable to find our IP on ' + self.url)
+        with self.lock:
+            self.cache[str(port)] = (match.group(1), time.time())
+            self._save()
+        return match.group(1)
+
+    def start(self, ports, callback=None):
+        """Look up every port on a background thread"""
+        def run():
+            for port in ports:
+                try:
+                    ip = self.lookup(port)
+                except Exception as e:
+                    logger.log('[-] Identity check failed on port {}: {}'.format(port, e), RED)
+                    continue
+                if callback:
+                    callback(port, ip)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def invalidate(self, port):
+        """Forget the IP of a circuit, after it has been renewed"""
+        with self.lock:
+            if self.cache.pop(str(port), None):
+                self._save()
+
+    def _load(self):
+        """Read the cache file"""
+        if not self.path or not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path) as handler:
+                return {port: tuple(entry) for port, entry in json.load(handler).items()}
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        """Write the cache file atomically"""
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.path + '.tmp', 'w') as handler:
+            json.dump(self.cache, handler)
+        os.replace(self.path + '.tmp', self.path)